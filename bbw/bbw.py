@@ -4,18 +4,25 @@
 
 import pandas as pd
 import requests
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 import re
 import difflib
 from datetime import date
-from bs4 import BeautifulSoup
 import time
-import ftfy
 import numpy as np
 import random
 import string
 import os
-import langid
+import hashlib
+import pickle
+import json
+import sqlite3
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from functools import lru_cache
+from itertools import islice
+# ftfy, langid and bs4 are imported in the functions using them to speed up the start of workers
 
 
 url_query = "https://query.wikidata.org/sparql" # default URL for SPARQL endpoint
@@ -42,14 +49,288 @@ def random_user_agent(agent='bot4bbw-'):
     return random.choice(letters) + agent + random_agent
 
 
+table_deadline = contextvars.ContextVar('table_deadline', default=None)  # see AdaptiveTimeout.start_table()
+current_budget = contextvars.ContextVar('current_budget', default=None)  # the Budget counting the queries
+query_failures = contextvars.ContextVar('query_failures', default=None)  # see record_failure()
+
+
+def record_failure():
+    """Record a failed query (a timeout, an HTTP error or an unreachable host) in the current context,
+    so e.g. LookupCache can tell a failed lookup apart from a lookup which found nothing."""
+    failures = query_failures.get()
+    if failures is not None:
+        failures.append(1)
+
+
+def in_context(function):
+    """Wrap a function to run in a copy of the context of the caller, e.g. in a pool of threads.
+    Its queries keep the deadline and the Budget of the table of the caller."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+
+class AdaptiveTimeout:
+    """Adaptive per-query timeouts based on the observed latency distribution.
+
+    The timeout of a query kind is the `percentile` of its last `window` latencies
+    multiplied by `factor` and clipped to [minimum, maximum * default timeout].
+    Until `warmup` latencies of a kind are observed, its default timeout is used.
+    Only the latencies of successful (2xx) responses are recorded. A query which times out
+    is recorded with the timeout of its kind, even if the table budget cut it shorter.
+    If hedge=True, a duplicate request is sent when the first one is slower than the
+    `hedge_percentile` of the latencies, and the first response wins.
+    If table_budget is given (in seconds), the queries of a table share this budget:
+    start_table() starts it and no query may run beyond it. The deadline is kept in the
+    context of the thread which starts the table, so concurrent tables do not reset each
+    other's deadlines. Pools of threads which run the queries of a table use in_context().
+    The requests share the connection pool of one session.
+    """
+    defaults = {'label': 12.5, 'item': 2.5, 'prop': 5, 'type': 2, 'type2': 59,
+                'datatype': 2, 'common_class': 60, 'type_batch': 20, 'items': 2.5, 'claims': 12.5,
+                'projected': 5, 'prop_batch': 20, 'constrained': 20}
+
+    def __init__(self, percentile=95, factor=1.5, minimum=1.0, maximum=4.0, window=200, warmup=20,
+                 hedge=False, hedge_percentile=90, table_budget=None):
+        self.percentile = percentile
+        self.factor = factor
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.warmup = warmup
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.table_budget = table_budget
+        self.latencies = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+    def start_table(self):
+        """Start the time budget of a new table in the current context."""
+        table_deadline.set(time.monotonic() + self.table_budget if self.table_budget else None)
+
+    def remaining(self):
+        """Seconds left in the time budget of the current table or None."""
+        deadline = table_deadline.get()
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def record(self, kind, latency):
+        """Record the latency of a query of the given kind."""
+        with self._lock:
+            if kind not in self.latencies:
+                self.latencies[kind] = deque(maxlen=self.window)
+            self.latencies[kind].append(latency)
+
+    def quantile(self, kind, percentile):
+        """Percentile of the recorded latencies of a kind or None during the warmup."""
+        with self._lock:
+            latencies = list(self.latencies.get(kind, []))
+        if len(latencies) < self.warmup:
+            return None
+        return float(np.percentile(latencies, percentile))
+
+    def timeout(self, kind, clipped=True):
+        """Timeout in seconds for the next query of the given kind. If clipped, it is at most
+        the remaining time budget of the table."""
+        default = self.defaults.get(kind, 12.5)
+        observed = self.quantile(kind, self.percentile)
+        if observed is None:
+            timeout = default
+        else:
+            timeout = min(max(observed * self.factor, self.minimum), self.maximum * default, 60)
+        remaining = self.remaining() if clipped else None
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        return timeout
+
+    def get(self, url, params, kind):
+        """GET the url with the timeout of the query kind. The latency is recorded."""
+        unclipped = self.timeout(kind, clipped=False)
+        timeout = self.timeout(kind)
+        if timeout <= 0:
+            raise requests.exceptions.Timeout('The time budget of the table is exhausted.')
+        with self._lock:
+            self.requests += 1
+        budget = current_budget.get()
+        if budget:
+            budget.count()
+        delay = self.quantile(kind, self.hedge_percentile) if self.hedge else None
+        start = time.monotonic()
+        try:
+            if delay is not None and delay < timeout:
+                r = self._hedged_get(url, params, timeout, delay)
+            else:
+                r = self.session.get(url, params=params, headers={'User-Agent': random_user_agent()}, timeout=timeout)
+        except requests.exceptions.Timeout:
+            self.record(kind, unclipped)  # censored: the latency is at least the timeout of the kind
+            raise
+        if 200 <= r.status_code < 300:  # fast 429 or 5xx answers would shrink the timeouts
+            self.record(kind, time.monotonic() - start)
+        return r
+
+    def _hedged_get(self, url, params, timeout, delay):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=8)
+            executor = self._executor
+        first = executor.submit(self.session.get, url, params=params,
+                                      headers={'User-Agent': random_user_agent()}, timeout=timeout)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        second = executor.submit(self.session.get, url, params=params,
+                                       headers={'User-Agent': random_user_agent()}, timeout=timeout - delay)
+        error = None
+        for future in as_completed([first, second]):
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+        raise error
+
+
+timeout_controller = AdaptiveTimeout()  # default timeouts of all SPARQL helpers
+
+
+def get_SPARQL_results(query, kind, url=url_query):
+    """
+    Parameters
+    ----------
+    query : str
+        SPARQL query.
+    kind : str
+        Kind of the query, e.g. 'label', 'item', 'prop', 'type' or 'type2'.
+        The timeout of the request adapts to the latencies of this kind.
+    url : str, optional
+        SPARQL-endpoint. The default is "https://query.wikidata.org/sparql".
+    Returns
+    -------
+    r : requests.Response
+        The response. After HTTP 429 the request is repeated once after Retry-After seconds.
+        Exceptions and responses other than 2xx are recorded with record_failure().
+    """
+    params = {'format': 'json', 'query': query}
+    try:
+        r = timeout_controller.get(url, params, kind)
+        if r.status_code == 429:
+            retry_after = int(r.headers["Retry-After"])
+            remaining = timeout_controller.remaining()
+            if remaining is not None and remaining < retry_after:
+                raise requests.exceptions.Timeout('The time budget of the table is exhausted.')
+            time.sleep(retry_after)
+            r = timeout_controller.get(url, params, kind)
+    except Exception:
+        record_failure()
+        raise
+    if not 200 <= r.status_code < 300:
+        record_failure()
+    return r
+
+
+class Budget:
+    """Time and request budget for the optional steps 3-6 in contextual_matching.
+
+    The limits are given per table (table_seconds, table_requests) and per run
+    (run_seconds, run_requests), where a run is the lifetime of the Budget object
+    and requests are the SPARQL queries. Only the queries of the tables of this budget
+    are counted, i.e. those in the context in which start_table() was called (see
+    in_context()), not those of other tables running at the same time. Step 2 is always executed. Before each
+    query of steps 3-6 allows() checks that the budget is not exhausted and that
+    the expected latency of the query fits into the remaining time, so cheap
+    queries may still run when expensive ones are skipped.
+    The skipped rows are recorded in the list skipped as [filename, row, step].
+    """
+
+    def __init__(self, table_seconds=None, table_requests=None, run_seconds=None, run_requests=None):
+        self.table_seconds = table_seconds
+        self.table_requests = table_requests
+        self.run_seconds = run_seconds
+        self.run_requests = run_requests
+        self.skipped = []
+        self.run_start = time.monotonic()
+        self.table_start = self.run_start
+        self.requests = 0
+        self.table_requests0 = 0
+        self._lock = threading.Lock()
+
+    def start_table(self):
+        """Start the budget of a new table. Its queries in the current context are counted."""
+        self.table_start = time.monotonic()
+        with self._lock:
+            self.table_requests0 = self.requests
+        current_budget.set(self)
+
+    def count(self):
+        """Count a SPARQL query of a table of this budget."""
+        with self._lock:
+            self.requests += 1
+
+    def remaining(self):
+        """Seconds left in the budget of the current table and of the run or None."""
+        now = time.monotonic()
+        remaining = [limit - (now - start) for limit, start in
+                     [(self.table_seconds, self.table_start), (self.run_seconds, self.run_start)] if limit]
+        return min(remaining) if remaining else None
+
+    def allows(self, kind):
+        """True if a SPARQL query of the given kind fits into the budget."""
+        with self._lock:
+            requests = self.requests
+        if self.table_requests and requests - self.table_requests0 >= self.table_requests:
+            return False
+        if self.run_requests and requests >= self.run_requests:
+            return False
+        remaining = self.remaining()
+        if remaining is None:
+            return True
+        expected = timeout_controller.quantile(kind, 50)
+        if expected is None:
+            expected = timeout_controller.defaults.get(kind, 12.5)
+        return expected < remaining
+
+    def skip(self, filename, rows, step):
+        """Record the rows of a table which are skipped in a step."""
+        self.skipped.extend([[filename, row, step] for row in rows])
+
+
+def preload_language_model():
+    """Load the model of langid once, e.g. at the start of a worker, instead of at its first use."""
+    import langid
+    if langid.langid.identifier is None:
+        langid.langid.load_model()
+
+
+@lru_cache(maxsize=2**17)
 def get_language(string):
-    """ https://github.com/IBCNServices/CSV2KG/blob/master/csv2kg/util.py#L15-L19 """
+    """ https://github.com/IBCNServices/CSV2KG/blob/master/csv2kg/util.py#L15-L19
+    The languages are cached by string."""
+    import langid
     try:
         return langid.classify(string)[0]
     except Exception:
         return 'en'
 
 
+def get_languages(strings):
+    """Get the languages of a column (list of strings). Each distinct string is classified only once."""
+    languages = {string: get_language(string) for string in set(strings)}
+    return [languages[string] for string in strings]
+
+
+def get_table_language(filecsv, column=0):
+    """Get the majority language of the values in a column of a table, without its header row.
+    Returns an empty string for an empty column."""
+    languages = get_languages([value for value in filecsv.iloc[1:, column].to_list() if value])
+    if not languages:
+        return ''
+    return Counter(languages).most_common(1)[0][0]
+
+
 def get_datatype(prop, url=url_query):
     """
     Parameters
@@ -69,10 +350,7 @@ def get_datatype(prop, url=url_query):
         query = """SELECT ?datatype WHERE {
             ?x wikibase:directClaim wdt:""" + prop + """;
             wikibase:propertyType ?datatype.}"""
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()},
-                         timeout=2)
+        r = get_SPARQL_results(query, 'datatype', url)
         results = r.json().get('results').get('bindings')
         datatype = results[0].get('datatype').get('value')
         if datatype:
@@ -126,16 +404,148 @@ def get_SPARQL_dataframe(name, language,
             LIMIT 100000
             """
     try:
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()},
-                         timeout=12.5)
-        if r.status_code == 429:
-            time.sleep(int(r.headers["Retry-After"]))
-            r = requests.get(url,
-                             params={'format': 'json', 'query': query},
-                             headers={'User-Agent': random_user_agent()},
-                             timeout=12.5)
+        r = get_SPARQL_results(query, 'label', url)
+        results = r.json().get('results').get("bindings")
+        for prop in results:
+            if 'psvalueLabel' in prop and prop.get('psvalueLabel').get('value') is not None:
+                prop['valueLabel']['value'] = prop.get('psvalueLabel').get('value')
+            prop.update((key, value.get('value')) for key, value in prop.items())
+        if len(results) != 0:
+            output = pd.DataFrame(results, dtype=str)
+        else:
+            output = None
+    except Exception:
+        output = None
+
+    return output
+
+
+def get_SPARQL_items(name, language, url=url_query):
+    """
+    Parameters
+    ----------
+    name : str
+        Possible mention in wikidata.
+    language : str
+        Language of the mention.
+    url : str, optional
+        SPARQL-endpoint. The default is "https://query.wikidata.org/sparql".
+    Returns
+    -------
+    output : pd.DataFrame
+        Dataframe with the columns item and p1: the items with the mention and the
+        predicates of the mention, i.e. the first half of get_SPARQL_dataframe().
+    """
+    name = name.replace('"', '\\\"')
+    query = """SELECT DISTINCT ?item ?p1 WHERE {
+                ?item ?p1 """ + '"' + name + '"' + "@" + language + """.
+            }
+            LIMIT 10000
+            """
+    try:
+        r = get_SPARQL_results(query, 'items', url)
+        results = r.json().get('results').get('bindings')
+        # blank nodes can not be asked for their claims
+        results = [prop for prop in results if prop.get('item').get('type') == 'uri']
+        for prop in results:
+            prop.update((key, value.get('value')) for key, value in prop.items())
+        if len(results) > 0:
+            output = pd.DataFrame(results, dtype=str)
+        else:
+            output = None
+    except Exception:
+        output = None
+
+    return output
+
+
+def get_SPARQL_claims(items, language, url=url_query, ptype=ptype):
+    """
+    Parameters
+    ----------
+    items : list
+        URLs of items in wikidata.
+    language : str
+        Language of the labels.
+    url : str, optional
+        SPARQL-endpoint. The default is "https://query.wikidata.org/sparql".
+    Returns
+    -------
+    output : pd.DataFrame
+        Dataframe with the claims of the items and the columns item, itemType, p2, value,
+        valueType and valueLabel, i.e. the second half of get_SPARQL_dataframe().
+    """
+    items = ' '.join(['<' + item + '>' for item in items])
+    query = """SELECT DISTINCT ?item ?itemType ?p2 ?value ?valueType ?valueLabel ?psvalueLabel WHERE {
+                VALUES ?item { """ + items + """ }
+                ?item ?p2 ?value.
+                OPTIONAL { ?item wdt:""" + ptype + """ ?itemType. }
+                OPTIONAL { ?value wdt:""" + ptype + """ ?valueType. }
+                OPTIONAL {
+                    ?wdproperty wikibase:claim ?p2 ;
+                        wikibase:statementProperty ?psproperty .
+                    ?value ?psproperty ?psvalue .
+                }
+                SERVICE wikibase:label { bd:serviceParam wikibase:language """ + '"' + language + '"' + """. }
+            }
+            LIMIT 100000
+            """
+    try:
+        r = get_SPARQL_results(query, 'claims', url)
+        results = r.json().get('results').get("bindings")
+        for prop in results:
+            if 'psvalueLabel' in prop and prop.get('psvalueLabel').get('value') is not None:
+                prop['valueLabel']['value'] = prop.get('psvalueLabel').get('value')
+            prop.update((key, value.get('value')) for key, value in prop.items())
+        if len(results) != 0:
+            output = pd.DataFrame(results, dtype=str)
+        else:
+            output = None
+    except Exception:
+        output = None
+
+    return output
+
+
+def get_SPARQL_claims_projected(items, values, language, url=url_query, ptype=ptype):
+    """
+    Parameters
+    ----------
+    items : list
+        URLs of items in wikidata.
+    values : list
+        Values of the cells of a row.
+    language : str
+        Language of the labels.
+    url : str, optional
+        SPARQL-endpoint. The default is "https://query.wikidata.org/sparql".
+    Returns
+    -------
+    output : pd.DataFrame
+        get_SPARQL_claims() projected on the server to the claims whose valueLabel is
+        equal to one of the values, ignoring the case, i.e. the claims for match_exact().
+    """
+    items = ' '.join(['<' + item + '>' for item in items])
+    keys = ', '.join(sorted(set(['"' + normalize_target(value).lower().replace('"', '\\\"') + '"' for value in values])))
+    query = """SELECT DISTINCT ?item ?itemType ?p2 ?value ?valueType ?valueLabel ?psvalueLabel WHERE {
+                VALUES ?item { """ + items + """ }
+                ?item ?p2 ?value.
+                OPTIONAL { ?value rdfs:label ?label. FILTER (lang(?label) = """ + '"' + language + '"' + """). }
+                OPTIONAL {
+                    ?wdproperty wikibase:claim ?p2 ;
+                        wikibase:statementProperty ?psproperty .
+                    ?value ?psproperty ?psvalue .
+                    OPTIONAL { ?psvalue rdfs:label ?pslabel. FILTER (lang(?pslabel) = """ + '"' + language + '"' + """). }
+                }
+                FILTER (LCASE(STR(COALESCE(?pslabel, ?psvalue, ?label, ?value))) IN (""" + keys + """))
+                OPTIONAL { ?item wdt:""" + ptype + """ ?itemType. }
+                OPTIONAL { ?value wdt:""" + ptype + """ ?valueType. }
+                SERVICE wikibase:label { bd:serviceParam wikibase:language """ + '"' + language + '"' + """. }
+            }
+            LIMIT 100000
+            """
+    try:
+        r = get_SPARQL_results(query, 'projected', url)
         results = r.json().get('results').get("bindings")
         for prop in results:
             if 'psvalueLabel' in prop and prop.get('psvalueLabel').get('value') is not None:
@@ -181,16 +591,7 @@ def get_SPARQL_dataframe_item(name, language,
             LIMIT 10000
             """
     try:
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()},
-                         timeout=2.5)
-        if r.status_code == 429:
-            time.sleep(int(r.headers["Retry-After"]))
-            r = requests.get(url,
-                             params={'format': 'json', 'query': query},
-                             headers={'User-Agent': random_user_agent()},
-                             timeout=2.5)
+        r = get_SPARQL_results(query, 'item', url)
         results = r.json().get('results').get('bindings')
         for prop in results:
             prop.update((key, value.get('value')) for key, value in prop.items())
@@ -229,16 +630,7 @@ def get_SPARQL_dataframe_prop(prop, value, url=url_query, ptype=ptype):
     LIMIT 50000
     """
     try:
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()},
-                         timeout=5)  # To avoid 1 min. timeouts.
-        if r.status_code == 429:
-            time.sleep(int(r.headers["Retry-After"]))
-            r = requests.get(url,
-                             params={'format': 'json', 'query': query},
-                             headers={'User-Agent': random_user_agent()},
-                             timeout=5)
+        r = get_SPARQL_results(query, 'prop', url)
         results = r.json().get('results').get('bindings')
         for prop in results:
             if 'psvalueLabel' in prop and prop.get('psvalueLabel').get('value') is not None:
@@ -254,6 +646,64 @@ def get_SPARQL_dataframe_prop(prop, value, url=url_query, ptype=ptype):
     return output
 
 
+def get_SPARQL_dataframe_prop_batch(prop, values, url=url_query, ptype=ptype):
+    """
+    Parameters
+    ----------
+    prop : list
+        PIDs of the properties of the entity columns.
+    values : list
+        The values of the entity columns, one list per row.
+    url : str, optional
+        SPARQL-endpoint. The default is "https://query.wikidata.org/sparql".
+    Returns
+    -------
+    output : list
+        get_SPARQL_dataframe_prop(prop, value) for each value in values, i.e. a dataframe or None
+        per row, from a single query with a VALUES table. Equal rows are asked once.
+    """
+    distinct = list(dict.fromkeys([tuple(value) for value in values]))
+    rows = ' '.join(['(' + str(key) + ' ' + ' '.join(['"' + str(val).replace('"', '\\\"') + '"@en' for val in value]) + ')'
+                     for key, value in enumerate(distinct)])
+    variables = ' '.join(['?label' + str(ind) for ind in range(len(prop))])
+    subquery = ' '.join([""" wdt:""" + str(p) + """ [ ?p ?label""" + str(ind) + """ ] ;
+        wdt:""" + str(p) + " ?value" + str(ind) + ";" for ind, p in enumerate(prop)])
+    query = """
+    SELECT REDUCED ?key ?item ?itemType ?itemLabel ?p2 ?value ?valueType ?valueLabel ?psvalueLabel WHERE {
+  VALUES (?key """ + variables + """) { """ + rows + """ }
+  ?item """ + subquery + """
+        ?p2 ?value.
+  ?item wdt:""" + ptype + """ ?itemType;
+        rdfs:label ?itemLabel.
+  FILTER (lang(?itemLabel) = "en").
+  OPTIONAL {
+  ?value wdt:""" + ptype + """ ?valueType .}
+  OPTIONAL {?wdproperty wikibase:claim ?p2 ;
+                        wikibase:statementProperty ?psproperty .
+            ?value ?psproperty ?psvalue .}
+   SERVICE wikibase:label { bd:serviceParam wikibase:language "en". }
+   }
+    LIMIT """ + str(50000 * len(distinct)) + """
+    """
+    output = {}
+    try:
+        r = get_SPARQL_results(query, 'prop_batch', url)
+        results = r.json().get('results').get('bindings')
+        for prop in results:
+            if 'psvalueLabel' in prop and prop.get('psvalueLabel').get('value') is not None:
+                prop['valueLabel']['value'] = prop.get('psvalueLabel').get('value')
+            prop.update((key, value.get('value')) for key, value in prop.items())
+        if len(results) > 0:
+            df = pd.DataFrame(results, dtype=str)
+            for key, group in df.groupby('key', sort=False):
+                # the columns without values in this row are left out as in get_SPARQL_dataframe_prop()
+                output[distinct[int(key)]] = group.drop(columns=['key']).dropna(axis=1, how='all').reset_index(drop=True)
+    except Exception:
+        output = {}
+
+    return [output.get(tuple(value)) for value in values]
+
+
 def get_SPARQL_dataframe_type(name, datatype, language, url=url_query, ptype=ptype):
     name = name.replace('"', '\\\"')
     if language:
@@ -267,16 +717,95 @@ def get_SPARQL_dataframe_type(name, datatype, language, url=url_query, ptype=pty
         }
         LIMIT 10000"""
     try:
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()},
-                         timeout=2)
-        if r.status_code == 429:
-            time.sleep(int(r.headers["Retry-After"]))
-            r = requests.get(url,
-                             params={'format': 'json', 'query': query},
-                             headers={'User-Agent': random_user_agent()},
-                             timeout=2)
+        r = get_SPARQL_results(query, 'type', url)
+        results = r.json().get('results').get('bindings')
+        for prop in results:
+            prop.update((key, value.get('value')) for key, value in prop.items())
+        if len(results) > 0:
+            output = pd.DataFrame(results, dtype=str)
+        else:
+            output = None
+    except Exception:
+        output = None
+
+    return output
+
+
+def get_SPARQL_dataframe_type_batch(names, datatype, language, url=url_query, ptype=ptype):
+    """
+    Parameters
+    ----------
+    names : list
+        Possible labels of items with the type datatype.
+    datatype : str
+        QID of the type.
+    language : str
+        Language of the labels.
+    Returns
+    -------
+    output : pd.DataFrame
+        Dataframe with the columns name, item and itemLabel, i.e. get_SPARQL_dataframe_type()
+        for all names in a single query.
+    """
+    names = ' '.join(['"' + name.replace('"', '\\\"') + '"@' + language for name in names])
+    query = """SELECT DISTINCT ?name ?item ?itemLabel WHERE {
+        VALUES ?name { """ + names + """ }
+        {?item  (rdfs:label|skos:altLabel) ?name.}
+        ?item wdt:""" + ptype + """ wd:""" + datatype + """.
+        SERVICE wikibase:label { bd:serviceParam wikibase:language """ + '"' + language + '"' + """. }
+        }
+        LIMIT 100000"""
+    try:
+        r = get_SPARQL_results(query, 'type_batch', url)
+        results = r.json().get('results').get('bindings')
+        for prop in results:
+            prop.update((key, value.get('value')) for key, value in prop.items())
+        if len(results) > 0:
+            output = pd.DataFrame(results, dtype=str)
+        else:
+            output = None
+    except Exception:
+        output = None
+
+    return output
+
+
+def get_SPARQL_dataframe_constrained(names, datatype, properties, language, url=url_query, ptype=ptype):
+    """
+    Parameters
+    ----------
+    names : list
+        Possible labels of items with the type datatype.
+    datatype : str
+        QID of the type.
+    properties : list
+        URLs of the properties, e.g. http://www.wikidata.org/prop/direct/P17.
+    language : str
+        Language of the labels.
+    url : str, optional
+        SPARQL-endpoint. The default is "https://query.wikidata.org/sparql".
+    Returns
+    -------
+    output : pd.DataFrame
+        Dataframe with the column name and the columns of get_SPARQL_dataframe(), but only
+        for the items with the type datatype and their claims with the properties, for all
+        names in a single query.
+    """
+    names = ' '.join(['"' + name.replace('"', '\\\"') + '"@' + language for name in names])
+    properties = ' '.join(['<' + prop + '>' for prop in properties])
+    query = """SELECT DISTINCT ?name ?item ?itemType ?p2 ?value ?valueType ?valueLabel WHERE {
+        VALUES ?name { """ + names + """ }
+        VALUES ?p2 { """ + properties + """ }
+        ?item (rdfs:label|skos:altLabel) ?name;
+              wdt:""" + ptype + """ wd:""" + datatype + """;
+              ?p2 ?value.
+        OPTIONAL { ?item wdt:""" + ptype + """ ?itemType. }
+        OPTIONAL { ?value wdt:""" + ptype + """ ?valueType. }
+        SERVICE wikibase:label { bd:serviceParam wikibase:language """ + '"' + language + '"' + """. }
+        }
+        LIMIT 100000"""
+    try:
+        r = get_SPARQL_results(query, 'constrained', url)
         results = r.json().get('results').get('bindings')
         for prop in results:
             prop.update((key, value.get('value')) for key, value in prop.items())
@@ -308,16 +837,7 @@ def get_SPARQL_dataframe_type2(datatype, language, url=url_query, ptype=ptype):
         }
         """+limit
     try:
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()},
-                         timeout=59)
-        if r.status_code == 429:
-            time.sleep(int(r.headers["Retry-After"]))
-            r = requests.get(url,
-                             params={'format': 'json', 'query': query},
-                             headers={'User-Agent': random_user_agent()},
-                             timeout=59)
+        r = get_SPARQL_results(query, 'type2', url)
         results = r.json().get('results').get('bindings')
         for prop in results:
             prop.update((key, value.get('value')) for key, value in prop.items())
@@ -417,6 +937,52 @@ def get_wikidata_title(url, url_front=url_front):
     return title
 
 
+def get_wikidata_titles(urls, url_front=url_front, chunksize=50):
+    """
+    Parameters
+    ----------
+    urls : list
+        URLs of Wikidata pages.
+    chunksize : int
+        The number of entities per request. The Wikidata API allows at most 50.
+    Returns
+    -------
+    titles: dict
+        Title of a Wikidata page for each URL. It is '' if there is no English label.
+    """
+    titles = {}
+    ids = {}
+    for url in set(urls):
+        entity = url.replace(url_front+'/prop/direct/', url_front+'/entity/')
+        if entity.startswith(url_front+'/entity/'):
+            ids.setdefault(entity.split('/')[-1], []).append(url)
+        else:
+            titles[url] = get_wikidata_title(url, url_front=url_front)
+    ids_list = sorted(ids)
+    for i in range(0, len(ids_list), chunksize):
+        chunk = ids_list[i:i + chunksize]
+        try:
+            params = {"action": "wbgetentities",
+                      "format": "json",
+                      "props": "labels",
+                      "languages": "en",
+                      "ids": "|".join(chunk)}
+            r = requests.get(url_front + '/w/api.php', params=params,
+                             headers={'User-Agent': random_user_agent()}, timeout=5).json()
+            entities = r.get('entities')
+        except Exception:
+            entities = {}
+        for qid in chunk:
+            entity = entities.get(qid) if entities else None
+            for url in ids[qid]:
+                if entity is None or 'missing' in entity:
+                    # a failed request or a redirect: fall back to the single request
+                    titles[url] = get_wikidata_title(url, url_front=url_front)
+                else:
+                    titles[url] = entity.get('labels', {}).get('en', {}).get('value', '')
+    return titles
+
+
 def get_title(url):
     """
     Parameters
@@ -428,6 +994,7 @@ def get_title(url):
     title: str
         Title of a web-page.
     """
+    from bs4 import BeautifulSoup
     try:
         r = requests.get(url, headers={'User-Agent': random_user_agent()}, timeout=1)
         title = BeautifulSoup(r.text, features="lxml").title.text
@@ -448,6 +1015,7 @@ def get_wikimedia2wikidata_title(wikimedia_url):
     title : str
         The title of the corresponding Wikidata page.
     """
+    from bs4 import BeautifulSoup
     try:
         r = requests.get(wikimedia_url, headers={'User-Agent': random_user_agent()}, timeout=1)
         soup = BeautifulSoup(r.content, 'html.parser')
@@ -498,123 +1066,181 @@ def get_wikipedia2wikidata_title(wikipedia_title, url_front=url_front):
     return bestname
 
 
-def get_searx_bestname(name):
+def fan_out(calls, deadline, workers=8, stop=None):
+    """
+    Parameters
+    ----------
+    calls : list
+        Independent calls [(key, function, args)].
+    deadline : float
+        Point in time (time.monotonic()) after which the outstanding calls are cancelled.
+    workers : int, optional
+        Number of threads. The default is 8.
+    stop : function, optional
+        stop(key, result) may return further calls [(key, function, args)], or True to
+        cancel all outstanding calls, e.g. once a good enough candidate is found.
+    Returns
+    -------
+    results : list
+        [(key, result)] of the calls finished in time. Failed calls are left out.
+    """
+    results = []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        for (key, function, args) in calls:
+            pending[executor.submit(in_context(function), *args)] = key
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(list(pending), timeout=remaining, return_when=FIRST_COMPLETED)
+            cancel = False
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    continue
+                results.append((key, result))
+                more = stop(key, result) if stop else None
+                if more is True:
+                    cancel = True
+                elif more:
+                    for (key2, function, args) in more:
+                        pending[executor.submit(in_context(function), *args)] = key2
+            if cancel:
+                break
+    finally:
+        # Calls which are already running finish in their threads, but nobody waits for them
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return results
+
+
+def clean_title(title):
+    """Remove the site name and namespaces from the title of a web-page."""
+    return title.split(" - ")[0].split(" ? ")[0].split(" ? ")[0].split(' \u2014 ')[0].split(
+        ' \u2013 ')[0].replace('Talk:', '').replace('Category:', '')
+
+
+def get_searx_results(query, deadline):
+    """The json-results of the Searx metasearch engine for the query, no later than the deadline."""
+    url = os.getenv("BBW_SEARX_URL", "http://localhost:80")
+    engines = "!yh !ddd !eto !bi !ew !et !wb !wq !ws !wt !wv !wy !tl !qw !mjk !nvr !wp !cc !wd !ddg !sp !yn !dc "
+    data = {"q": engines + query, "format": "json"}
+    timeout = max(deadline - time.monotonic(), 0.001)
+    return requests.get(url, data=data, headers={'User-Agent': random_user_agent()}, timeout=timeout).json()
+
+
+def get_searx_bestname(name, deadline=10, workers=8, cutoff=0.7):
     """
     Parameters
     ----------
     name : str
         Possible entity label in wikidata.
+    deadline : float, optional
+        Total time in seconds for all requests. The default is 10.
+    workers : int, optional
+        Number of concurrent requests. The default is 8.
+    cutoff : float, optional
+        Outstanding OpenRefine- and Wikipedia-lookups are cancelled as soon as one
+        returns a name this similar to the given name. The default is 0.7.
     Returns
     -------
     bestname : str
         A few best suggestions returned by the Searx metasearch engine.
     """
+    deadline = time.monotonic() + deadline
     name_cleaned = name.replace('!', ' ').replace('#', ' ').replace(':-', ' -')
-    url = os.getenv("BBW_SEARX_URL", "http://localhost:80")
-    engines = "!yh !ddd !eto !bi !ew !et !wb !wq !ws !wt !wv !wy !tl !qw !mjk !nvr !wp !cc !wd !ddg !sp !yn !dc "
-    data = {"q": engines + name_cleaned, "format": "json"}
     try:
-        results = requests.get(url, data=data, headers={'User-Agent': random_user_agent()}).json()
-        if 'results' not in locals():
-            raise Exception
+        results = get_searx_results(name_cleaned, deadline)
+    except Exception:
+        record_failure()  # The further requests are best effort, only the first one decides
+        return None
+    try:
         bestname = []
         medianame = []
+        calls = []
         # Process infoboxes
-        if len(results.get('infoboxes')) > 0:
-            bestname.extend([x.get('infobox') for x in results.get('infoboxes')])
+        infoboxes = [x.get('infobox') for x in results.get('infoboxes')]
+        bestname.extend(infoboxes)
         # Process suggestions
         if len(results.get('suggestions')) > 0:
-            bestname.extend([k for k in results.get('suggestions') if not re.search("[\uac00-\ud7a3]", k)])
-            for sugg in results.get('suggestions'):
+            suggestions = [k for k in results.get('suggestions') if not re.search("[\uac00-\ud7a3]", k)]
+            bestname.extend(suggestions)
+            for sugg in suggestions:
                 splitsugg = sugg.split()
-                if len(splitsugg) > 2 and not re.search("[\uac00-\ud7a3]", sugg):
+                if len(splitsugg) > 2:
                     bestname.extend([' '.join(splitsugg[:-1])])
-            best_sugg = difflib.get_close_matches(name, [k for k in results.get('suggestions') if
-                                                         not re.search("[\uac00-\ud7a3]", k)], n=1, cutoff=0.65)
-            try:
-                data2 = {"q": engines + best_sugg[0], "format": "json"}
-                results2 = requests.get(url, data=data2, headers={'User-Agent': random_user_agent()}).json()
-                if results2:
-                    if len(results2.get('infoboxes')) > 0:
-                        bestname.extend([x.get('infobox') for x in results2.get('infoboxes')])
-            except Exception:
-                pass
+            best_sugg = difflib.get_close_matches(name, suggestions, n=1, cutoff=0.65)
+            if best_sugg:
+                calls.append(('infobox', get_searx_results, (best_sugg[0], deadline)))
         # Process corrections
         if len(results.get('corrections')) > 0:
             corrections = [corr for corr in results.get('corrections') if '"' not in corr]
-            if len(corrections) > 0:
-                for correction in corrections:
-                    try:
-                        data3 = {"q": engines + correction, "format": "json"}
-                        results3 = requests.get(url, data=data3, headers={'User-Agent': random_user_agent()}).json()
-                        if results3:
-                            if len(results3.get('infoboxes')) > 0:
-                                bestname.extend([x.get('infobox') for x in results3.get('infoboxes')])
-                    except Exception:
-                        pass
-                bestname.extend(corrections)
+            for correction in corrections:
+                calls.append(('infobox', get_searx_results, (correction, deadline)))
+            bestname.extend(corrections)
         # Process search results
-        if len(results.get('results')) > 0:
-            for i, result in enumerate(results.get('results')):
-                url = result.get('url')
-                parsed_url=result.get('parsed_url')
-                if len(parsed_url) > 1:
-                    hostname = parsed_url[1]
-                raw_title = result.get('title')
-                if i == 1:
-                    bestname.append(
-                        raw_title.split(' | ')[0].split(" - ")[0].split(" ? ")[0].split(" ? ")[0].split(' \u2014 ')[
-                            0].split(' \u2013 ')[0].replace('Talk:', '').replace('Category:', '').replace('...', ''))
-                if ("wiki" in url) and not raw_title.endswith('...'):
-                    bestname.append(
-                        raw_title.split(" - ")[0].split(" ? ")[0].split(" ? ")[0].split(' \u2014 ')[0].split(
-                            ' \u2013 ')[0].replace('Talk:', '').replace('Category:', ''))
-                if ("wiki" in url) and raw_title.endswith('...') and ("Wikidata:SPARQL" not in result.get('title')):
-                    title = get_title(url)
-                    if title:
-                        bestname.append(
-                            title.split(" - ")[0].split(" ? ")[0].split(" ? ")[0].split(' \u2014 ')[0].split(
-                                ' \u2013 ')[0].replace('Talk:', '').replace('Category:', ''))
-                if hostname:
-                    if hostname.endswith('.wikimedia.org'):
-                        title = get_wikimedia2wikidata_title(url)
-                        if title:
-                            medianame.append(
-                                title.split(" - ")[0].split(" ? ")[0].split(" ? ")[0].split(' \u2014 ')[0].split(
-                                    ' \u2013 ')[0])
-                if "dict" in url:
-                    bestname.append(raw_title.split(' : ')[0].split(' | ')[0])
-                raw_match = difflib.get_close_matches(name, [
-                    raw_title.replace(' ...', '').replace(' ?', '').split(' | ')[0].split(" - ")[0].split(' \u2014 ')[
-                        0].split(' \u2013 ')[0]], n=1, cutoff=0.7)
-                if len(raw_match) == 1:
-                    bestname.append(raw_match[0])
-        if len(bestname) > 0:
-            bestname = [best for best in bestname if best != name]
+        for i, result in enumerate(results.get('results')):
+            url = result.get('url')
+            parsed_url = result.get('parsed_url')
+            hostname = parsed_url[1] if len(parsed_url) > 1 else None
+            raw_title = result.get('title')
+            if i == 1:
+                bestname.append(clean_title(raw_title.split(' | ')[0]).replace('...', ''))
+            if ("wiki" in url) and not raw_title.endswith('...'):
+                bestname.append(clean_title(raw_title))
+            if ("wiki" in url) and raw_title.endswith('...') and ("Wikidata:SPARQL" not in raw_title):
+                calls.append(('title', get_title, (url,)))
+            if hostname and hostname.endswith('.wikimedia.org'):
+                calls.append(('media', get_wikimedia2wikidata_title, (url,)))
+            if "dict" in url:
+                bestname.append(raw_title.split(' : ')[0].split(' | ')[0])
+            raw_match = difflib.get_close_matches(name, [
+                raw_title.replace(' ...', '').replace(' ?', '').split(' | ')[0].split(" - ")[0].split(' \u2014 ')[
+                    0].split(' \u2013 ')[0]], n=1, cutoff=0.7)
+            if len(raw_match) == 1:
+                bestname.append(raw_match[0])
+        # The further Searx-queries and the scraping of the titles run concurrently
+        for (key, result) in fan_out(calls, deadline, workers):
+            if not result:
+                continue
+            if key == 'infobox':
+                boxes = [x.get('infobox') for x in result.get('infoboxes')]
+                bestname.extend(boxes)
+                infoboxes.extend(boxes)
+            elif key == 'title':
+                bestname.append(clean_title(result))
+            else:
+                medianame.append(result.split(" - ")[0].split(" ? ")[0].split(" ? ")[0].split(' \u2014 ')[0].split(
+                    ' \u2013 ')[0])
+        bestname = [best for best in bestname if best != name]
         suggestions = list(set(difflib.get_close_matches(name, bestname, n=3, cutoff=0.41)))
-        suggestions = suggestions + [get_openrefine_bestname(best) for best in suggestions]
-        suggestions = suggestions + [get_wikipedia2wikidata_title(best) for best in suggestions]
+
+        # Each suggestion is looked up with OpenRefine and Wikipedia, the names found by OpenRefine with
+        # Wikipedia as well. The lookups are cancelled once a name is at least as similar as the cutoff.
+        def found(key, result):
+            if not result:
+                return None
+            if difflib.get_close_matches(name, [result], n=1, cutoff=cutoff):
+                return True
+            if key == 'openrefine':
+                return [('wikipedia', get_wikipedia2wikidata_title, (result,))]
+            return None
+
+        calls = [('openrefine', get_openrefine_bestname, (best,)) for best in suggestions] + \
+                [('wikipedia', get_wikipedia2wikidata_title, (best,)) for best in suggestions]
+        suggestions = suggestions + [result for (key, result) in fan_out(calls, deadline, workers, stop=found)]
         suggestions = list(set([best for best in suggestions if best]))
-        bestname = difflib.get_close_matches(name, suggestions, n=3, cutoff=0.7)
-        if 'results' in locals():
-            if len(results.get('infoboxes')) > 0:
-                bestname.extend([x.get('infobox') for x in results.get('infoboxes')])
-        if 'results2' in locals():
-            if len(results2.get('infoboxes')) > 0:
-                bestname.extend([x.get('infobox') for x in results2.get('infoboxes')])
-        if 'results3' in locals():
-            if len(results3.get('infoboxes')) > 0:
-                bestname.extend([x.get('infobox') for x in results3.get('infoboxes')])
+        bestname = difflib.get_close_matches(name, suggestions, n=3, cutoff=0.7) + infoboxes
         if len(bestname) == 0:
             bestname = difflib.get_close_matches(name, suggestions, n=3, cutoff=0.41)
-            if len(bestname) == 0:
-                bestname = None
-        if len(medianame) > 0:
-            bestname.extend(medianame)
-        if len(bestname) > 0:
-            bestname = list(set([best for best in bestname if best != name]))
-            if len(bestname) == 0:
-                bestname = None
+        bestname = list(set([best for best in bestname + medianame if best != name]))
+        if len(bestname) == 0:
+            bestname = None
     except Exception:
         bestname = None
     return bestname
@@ -666,9 +1292,7 @@ def get_common_class(classes, url=url_query, url_front=url_front):
     } ORDER BY ?length
     LIMIT 1"""
     try:
-        r = requests.get(url,
-                         params={'format': 'json', 'query': query},
-                         headers={'User-Agent': random_user_agent()})
+        r = get_SPARQL_results(query, 'common_class', url)
         results = r.json().get('results').get('bindings')
         output = results[0].get('super').get('value')
     except Exception:
@@ -677,7 +1301,7 @@ def get_common_class(classes, url=url_query, url_front=url_front):
     return output
 
 
-def get_one_class(classes):
+def get_one_class(classes, provider=None):
     """
     Takes a list of two tuples with a class and the number of times it has appeared in a column.
     Returns a common class.
@@ -687,7 +1311,10 @@ def get_one_class(classes):
     if len(classes) == 1 or (len(classes) == 2 and classes[0][1] > classes[1][1]):
         return classes[0][0]
     if len(classes) == 2 and classes[0][1] == classes[1][1]:
-        one_class = get_common_class([classes[0][0], classes[1][0]])
+        if provider:
+            one_class = provider.get_common_class([classes[0][0], classes[1][0]])
+        else:
+            one_class = get_common_class([classes[0][0], classes[1][0]])
         if one_class == "http://www.wikidata.org/entity/Q35120":
             return classes[0][0]
         else:
@@ -712,38 +1339,384 @@ def lookup(name_in_data, language, metalookup=True, openrefine=False):
             1: OpenRefine Suggest API
             2: Searx-metasearch
     """
-    how_matched = ''
-    proper_name = ''
-    # Search entity using WD SPARQL-endpoint
-    WDdf = get_SPARQL_dataframe(name_in_data, language)
-    if isinstance(WDdf, pd.DataFrame):
-        proper_name = name_in_data
-        how_matched = 'SPARQL'  # This means we have found a mention of 'name_in_data' in Wikidata using single SPARQL-query
-    if isinstance(WDdf, pd.DataFrame):
-        if 'item' in WDdf.columns:
-            if all(WDdf.item.str.contains('wikipedia')):
-                WDdf = None
-    # Searx-metasearch-engine API
-    if metalookup:
-        if not isinstance(WDdf, pd.DataFrame):
-            proper_name = get_searx_bestname(name_in_data)
-            if proper_name:
-                test_list = []
-                for proper in proper_name:
-                    e = get_SPARQL_dataframe(proper, language)
-                    if isinstance(e, pd.DataFrame):
-                        test_list.append(e)
-                if len(test_list) > 0:
-                    WDdf = pd.concat(test_list)
-                    how_matched = 'SearX'  # proper_name is found in Wikidata
-    # OpenRefine-Reconciliation API
-    if openrefine:
-        if not isinstance(WDdf, pd.DataFrame):
-            proper_name = get_openrefine_bestname(name_in_data)
-            if proper_name:
-                WDdf = get_SPARQL_dataframe(proper_name, language)
-                how_matched = 'OpenRefine'  # proper_name is found in Wikidata
-    return [WDdf, how_matched, proper_name]
+    return WikidataProvider(metalookup=metalookup, openrefine=openrefine).lookup(name_in_data, language)
+
+
+class WikidataProvider:
+    """Access to the knowledge graph for contextual_matching, postprocessing and annotate.
+
+    The methods call the module-level helpers with the SPARQL-endpoint url and the
+    Wikibase frontend url_front of the provider. Subclasses may override any of them,
+    e.g. to cache or batch the queries or to answer them from a local backend.
+    """
+
+    def __init__(self, url=url_query, url_front=url_front, ptype=ptype, metalookup=True, openrefine=False,
+                 searx_deadline=10, projection=False):
+        self.url = url
+        self.url_front = url_front
+        self.ptype = ptype
+        self.metalookup = metalookup
+        self.openrefine = openrefine
+        self.searx_deadline = searx_deadline
+        self.projection = projection
+
+    def lookup(self, name_in_data, language):
+        """See lookup()."""
+        how_matched = ''
+        proper_name = ''
+        # Search entity using WD SPARQL-endpoint
+        WDdf = self.get_SPARQL_dataframe(name_in_data, language)
+        if isinstance(WDdf, pd.DataFrame):
+            proper_name = name_in_data
+            how_matched = 'SPARQL'  # This means we have found a mention of 'name_in_data' in Wikidata using single SPARQL-query
+        if isinstance(WDdf, pd.DataFrame):
+            if 'item' in WDdf.columns:
+                if all(WDdf.item.str.contains('wikipedia')):
+                    WDdf = None
+        # Searx-metasearch-engine API
+        if self.metalookup:
+            if not isinstance(WDdf, pd.DataFrame):
+                proper_name = self.get_searx_bestname(name_in_data)
+                if proper_name:
+                    test_list = []
+                    for proper in proper_name:
+                        e = self.get_SPARQL_dataframe(proper, language)
+                        if isinstance(e, pd.DataFrame):
+                            test_list.append(e)
+                    if len(test_list) > 0:
+                        WDdf = pd.concat(test_list)
+                        how_matched = 'SearX'  # proper_name is found in Wikidata
+        # OpenRefine-Reconciliation API
+        if self.openrefine:
+            if not isinstance(WDdf, pd.DataFrame):
+                proper_name = self.get_openrefine_bestname(name_in_data)
+                if proper_name:
+                    WDdf = self.get_SPARQL_dataframe(proper_name, language)
+                    how_matched = 'OpenRefine'  # proper_name is found in Wikidata
+        return [WDdf, how_matched, proper_name]
+
+    def lookup_projected(self, name_in_data, language, values):
+        """The first phase of a two-phase lookup (projection=True): the items labelled name_in_data
+        with only their claims whose valueLabel is one of the values (get_SPARQL_claims_projected()).
+        Returns [WDdf, how_matched, proper_name] like lookup(), WDdf is None without such claims."""
+        lang = language if language else get_language(name_in_data)
+        items = self.get_SPARQL_items(name_in_data, lang)
+        if items is None or all(items.item.str.contains('wikipedia')):
+            return [None, '', '']
+        claims = self.get_SPARQL_claims_projected(list(items.item.unique()), values, lang)
+        if claims is None:
+            return [None, '', '']
+        WDdf = items.merge(claims, on='item')
+        columns = ['item', 'itemType', 'p1', 'p2', 'value', 'valueType', 'valueLabel', 'psvalueLabel']
+        return [WDdf[[c for c in columns if c in WDdf.columns]], 'SPARQL', name_in_data]
+
+    def get_SPARQL_dataframe(self, name, language, extra=''):
+        return get_SPARQL_dataframe(name, language, url=self.url, extra=extra, ptype=self.ptype)
+
+    def get_SPARQL_items(self, name, language):
+        return get_SPARQL_items(name, language, url=self.url)
+
+    def get_SPARQL_claims(self, items, language):
+        return get_SPARQL_claims(items, language, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_claims_projected(self, items, values, language):
+        return get_SPARQL_claims_projected(items, values, language, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_item(self, name, language):
+        return get_SPARQL_dataframe_item(name, language, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_prop(self, prop, value):
+        return get_SPARQL_dataframe_prop(prop, value, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_prop_batch(self, prop, values):
+        return get_SPARQL_dataframe_prop_batch(prop, values, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_type(self, name, datatype, language):
+        return get_SPARQL_dataframe_type(name, datatype, language, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_type_batch(self, names, datatype, language):
+        return get_SPARQL_dataframe_type_batch(names, datatype, language, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_constrained(self, names, datatype, properties, language):
+        return get_SPARQL_dataframe_constrained(names, datatype, properties, language, url=self.url, ptype=self.ptype)
+
+    def get_SPARQL_dataframe_type2(self, datatype, language):
+        return get_SPARQL_dataframe_type2(datatype, language, url=self.url, ptype=self.ptype)
+
+    def get_common_class(self, classes):
+        return get_common_class(classes, url=self.url, url_front=self.url_front)
+
+    def get_datatype(self, prop):
+        return get_datatype(prop, url=self.url)
+
+    def get_wikidata_title(self, url):
+        return get_wikidata_title(url, url_front=self.url_front)
+
+    def get_wikidata_titles(self, urls):
+        return get_wikidata_titles(urls, url_front=self.url_front)
+
+    def get_searx_bestname(self, name):
+        return get_searx_bestname(name, deadline=self.searx_deadline)
+
+    def get_openrefine_bestname(self, name):
+        return get_openrefine_bestname(name)
+
+
+class LookupCache(WikidataProvider):
+    """A provider which shares the lookup results between rows, tables and processes.
+
+    Each (name, language) pair is looked up only once. With a directory, the results
+    are stored there as pickle files, so parallel workers and later runs reuse them.
+    Otherwise the last maxresults results are kept in memory. prefetch() resolves many
+    distinct names in parallel. A lookup with a failed query (see record_failure()), e.g.
+    a timeout, HTTP 429 or an unreachable Searx host, is returned but not stored, so it is
+    retried by the next row, worker or run. hits and misses count the lookups answered from
+    the cache and by the provider.
+    """
+
+    def __init__(self, directory=None, maxresults=100000, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.maxresults = maxresults
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name, language):
+        key = hashlib.sha1((language + '\t' + name).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.pkl')
+
+    def __contains__(self, key):
+        (name, language) = key
+        if self.directory:
+            return os.path.exists(self._path(name, language))
+        with self._lock:
+            return key in self.results
+
+    def lookup(self, name_in_data, language):
+        if self.directory:
+            try:
+                with open(self._path(name_in_data, language), 'rb') as f:
+                    result = pickle.load(f)
+                with self._lock:
+                    self.hits += 1
+                return result
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+        else:
+            with self._lock:
+                if (name_in_data, language) in self.results:
+                    self.results.move_to_end((name_in_data, language))
+                    self.hits += 1
+                    return self.results[(name_in_data, language)]
+        with self._lock:
+            self.misses += 1
+        [result, failed] = self._lookup(name_in_data, language)
+        if not failed:
+            self.store(name_in_data, language, result)
+        return result
+
+    def _lookup(self, name_in_data, language):
+        # The lookup of the provider and whether one of its queries failed
+        def run():
+            failures = []
+            query_failures.set(failures)
+            return [super(LookupCache, self).lookup(name_in_data, language), bool(failures)]
+        return contextvars.copy_context().run(run)
+
+    def store(self, name_in_data, language, result):
+        """Store the lookup result of a name."""
+        if self.directory:
+            path = self._path(name_in_data, language)
+            tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f)
+            os.replace(tmp, path)  # atomic, if several workers store the same name
+        else:
+            with self._lock:
+                self.results[(name_in_data, language)] = result
+                while len(self.results) > self.maxresults:
+                    self.results.popitem(last=False)
+
+    def prefetch(self, names, language, workers=8):
+        """Resolve the distinct names which are not in the cache yet using a pool of workers.
+        Returns the number of resolved names, without the failed lookups."""
+        names = [name for name in sorted(set(names)) if (name, language) not in self]
+        resolved = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            lookup = in_context(lambda name: self._lookup(name, language))
+            for name, [result, failed] in zip(names, executor.map(lookup, names)):
+                if not failed:
+                    self.store(name, language, result)
+                    resolved += 1
+        return resolved
+
+
+
+class CachedProvider(LookupCache):
+    """A LookupCache which also keeps the results of the other queries in memory.
+
+    Besides the lookups, the class-label indexes of step 6 (the largest queries),
+    the tail-value queries of step 4, the type-constrained queries of step 5, the
+    common classes, the datatypes and the titles are cached. At most maxsize class-label indexes are kept.
+    Failed queries (None or '') are not cached, so they are retried later.
+
+    The claims of the items are cached per item: get_SPARQL_dataframe() first asks for
+    the items with a label and then only for the claims of the items which are not
+    cached yet, so aliases and spelling variants of popular items like countries and
+    cities download their claims once. At most claims_maxsize items are kept.
+    Of the other queries, the last cachesize results are kept.
+    """
+
+    def __init__(self, maxsize=32, claims_maxsize=10000, claims_chunksize=50, cachesize=100000, **kwargs):
+        super().__init__(**kwargs)
+        self.maxsize = maxsize
+        self.class_labels = OrderedDict()
+        self.claims_maxsize = claims_maxsize
+        self.claims_chunksize = claims_chunksize
+        self.claims = OrderedDict()
+        self.claims_query_limit = 100000  # the LIMIT of get_SPARQL_claims()
+        self.cachesize = cachesize
+        self.cache = OrderedDict()
+
+    def _store(self, key, result):
+        # Called with the lock held
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+    def _cached(self, key, function, *args):
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        result = function(*args)
+        failed = result is None or (isinstance(result, str) and not result)
+        if not failed:
+            with self._lock:
+                self._store(key, result)
+        return result
+
+    def get_SPARQL_dataframe_type2(self, datatype, language):
+        key = (datatype, language)
+        with self._lock:
+            if key in self.class_labels:
+                self.class_labels.move_to_end(key)
+                return self.class_labels[key]
+        result = super().get_SPARQL_dataframe_type2(datatype, language)
+        if result is not None:
+            with self._lock:
+                self.class_labels[key] = result
+                while len(self.class_labels) > self.maxsize:
+                    self.class_labels.popitem(last=False)
+        return result
+
+    def get_SPARQL_dataframe(self, name, language, extra=''):
+        if extra:
+            return super().get_SPARQL_dataframe(name, language, extra=extra)
+        lang = language if language else get_language(name)
+        items = self.get_SPARQL_items(name, lang)
+        if items is None:
+            return None
+        claims = self.get_claims(list(items.item.unique()), lang)
+        if claims is None:
+            return None
+        output = items.merge(claims, on='item')
+        columns = ['item', 'itemType', 'p1', 'p2', 'value', 'valueType', 'valueLabel', 'psvalueLabel']
+        return output[[c for c in columns if c in output.columns]]
+
+    def get_claims(self, items, language, limit=100000):
+        """The claims of the items (get_SPARQL_claims()) in one dataframe. Only the items which
+        are not cached are queried, in chunks of claims_chunksize items. As with the single query
+        of get_SPARQL_dataframe(), no more items are queried once there are limit claims.
+        A chunk whose result reaches the LIMIT of the query may be truncated: it is split in halves
+        and queried again, and a single truncated item is used but not cached. The items without
+        claims in a complete result are cached as empty dataframes, so they are not queried again.
+        Returns None, if a query fails."""
+        claims = {}
+        with self._lock:
+            for item in items:
+                if (item, language) in self.claims:
+                    self.claims.move_to_end((item, language))
+                    claims[item] = self.claims[(item, language)]
+        size = sum(len(df) for df in claims.values())
+        missing = [item for item in items if item not in claims]
+        claims = {item: df for item, df in claims.items() if len(df) > 0}
+        chunks = [missing[i:i + self.claims_chunksize] for i in range(0, len(missing), self.claims_chunksize)]
+        chunks.reverse()
+        while chunks and size < limit:
+            chunk = chunks.pop()
+            result = self.get_SPARQL_claims(chunk, language)
+            if result is None:
+                return None
+            truncated = len(result) >= self.claims_query_limit
+            if truncated and len(chunk) > 1:
+                half = len(chunk) // 2
+                chunks.extend([chunk[half:], chunk[:half]])
+                continue
+            found = dict(list(result.groupby('item', sort=False)))
+            with self._lock:
+                for item in chunk:
+                    df = found.get(item, result.iloc[:0])
+                    if len(df) > 0:
+                        claims[item] = df
+                    if not truncated:
+                        self.claims[(item, language)] = df
+                while len(self.claims) > self.claims_maxsize:
+                    self.claims.popitem(last=False)
+            size += len(result)
+        if not claims:
+            return None
+        return pd.concat([claims[item] for item in items if item in claims], ignore_index=True)
+
+    def get_SPARQL_items(self, name, language):
+        return self._cached(('items', name, language), super().get_SPARQL_items, name, language)
+
+    def get_SPARQL_claims_projected(self, items, values, language):
+        # Once all claims of the items are cached, they are projected locally
+        with self._lock:
+            cached = [self.claims.get((item, language)) for item in items]
+        if any(claims is None for claims in cached):
+            return super().get_SPARQL_claims_projected(items, values, language)
+        claims = pd.concat(cached, ignore_index=True)
+        keys = set([normalize_target(value).lower() for value in values])
+        claims = claims[claims.valueLabel.str.lower().isin(keys)]
+        return claims.reset_index(drop=True) if len(claims) > 0 else None
+
+    def get_SPARQL_dataframe_item(self, name, language):
+        return self._cached(('item', name, language), super().get_SPARQL_dataframe_item, name, language)
+
+    def get_SPARQL_dataframe_type(self, name, datatype, language):
+        return self._cached(('type', name, datatype, language), super().get_SPARQL_dataframe_type,
+                            name, datatype, language)
+
+    def get_common_class(self, classes):
+        return self._cached(('common_class', tuple(classes)), super().get_common_class, classes)
+
+    def get_datatype(self, prop):
+        return self._cached(('datatype', prop), super().get_datatype, prop)
+
+    def get_wikidata_title(self, url):
+        return self._cached(('title', url), super().get_wikidata_title, url)
+
+    def get_wikidata_titles(self, urls):
+        with self._lock:
+            titles = {url: self.cache[('title', url)] for url in set(urls) if ('title', url) in self.cache}
+            for url in titles:
+                self.cache.move_to_end(('title', url))
+        missing = [url for url in set(urls) if url not in titles]
+        if missing:
+            new = super().get_wikidata_titles(missing)
+            with self._lock:
+                for url, title in new.items():
+                    if title:
+                        self._store(('title', url), title)
+            titles.update(new)
+        return titles
 
 
 def detect_name(value):
@@ -760,22 +1733,37 @@ def detect_name(value):
     return None
 
 
-def match(WDdf, target_value):
-    """Performs contextual matching for input dataframe and input target_value.
-    Returns the dataframe constrained to the objects equal to target_value."""
+def normalize_target(target_value):
+    """Removes the thousands separators of numbers and normalizes dates to yyyy-mm-dd."""
     if isfloat(target_value):
         target_value = target_value.replace(',', '')
-    isdate = re.match(r"^\d{4}-\d{2}-\d{2}", target_value)
-    # 0. Normalize dates
     match_date = re.match(r"^(\d{4})/(\d{2})/(\d{2})$", target_value)
     if match_date:
-        isdate = True
         target_value = match_date[1] + "-" + match_date[2] + "-" + match_date[3]
+    return target_value
+
+
+def match_exact(WDdf, target_value):
+    """Steps 1 and 2a of match(): the dataframe constrained to the objects whose valueLabel is
+    equal to target_value, ignoring the case for values which are no numbers."""
+    target_value = normalize_target(target_value)
     # 1. exact matching of valueLabels
     df = WDdf[WDdf.valueLabel == target_value]
     # 2a. case-insensitive exact matching of valueLabels
     if df.empty and not isfloat(target_value):
         df = WDdf[WDdf.valueLabel.str.lower() == str.lower(target_value)]
+    return df
+
+
+def match(WDdf, target_value):
+    """Performs contextual matching for input dataframe and input target_value.
+    Returns the dataframe constrained to the objects equal to target_value."""
+    # 0. Normalize numbers and dates
+    target_value = normalize_target(target_value)
+    isdate = re.match(r"^\d{4}-\d{2}-\d{2}", target_value)
+    # 1. and 2a. exact matching of valueLabels
+    df = match_exact(WDdf, target_value)
+    if df.empty and not isfloat(target_value):
         # 2b. inexact matching of valueLabels with high cuttoff=0.95
         if df.empty:
             approx_matches = difflib.get_close_matches(target_value, WDdf.valueLabel.to_list(), n=3, cutoff=0.95)
@@ -812,6 +1800,7 @@ def match(WDdf, target_value):
 
 def preprocessing(filecsv):
     """Simple preprocessing of a dataframe using ftfy.fix_text()."""
+    import ftfy
     filecsv = filecsv.fillna("")
     if len(filecsv.columns) == 1:  # Data augmentation for single-column tables
         filecsv[1] = filecsv[0]
@@ -819,14 +1808,107 @@ def preprocessing(filecsv):
     return filecsv
 
 
+def read_table(path, cache=None):
+    """Read a CSV-file with pd.read_csv(path, dtype=str, header=None) and preprocess it.
+    If cache is a folder, the preprocessed table is stored there as a pickle file and
+    later runs read it from there as long as the CSV-file is not modified."""
+    if cache:
+        stat = os.stat(path)
+        key = os.path.abspath(path) + '\t' + str(stat.st_mtime_ns) + '\t' + str(stat.st_size)
+        cached = os.path.join(cache, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+        try:
+            return pd.read_pickle(cached)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+    filecsv = preprocessing(pd.read_csv(path, dtype=str, header=None))
+    if cache:
+        os.makedirs(cache, exist_ok=True)
+        tmp = cached + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        filecsv.to_pickle(tmp)
+        os.replace(tmp, cached)  # atomic, if several workers store the same table
+    return filecsv
+
+
+def load_tables(paths, workers=4, cache=None, ahead=16):
+    """Generator of the preprocessed tables read by read_table(path, cache) in the order of paths.
+    A pool of workers reads up to ahead tables in advance, while the caller annotates the current one."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        paths = iter(paths)
+        futures = deque(executor.submit(read_table, path, cache) for path in islice(paths, ahead))
+        while futures:
+            filecsv = futures.popleft().result()
+            for path in islice(paths, 1):
+                futures.append(executor.submit(read_table, path, cache))
+            yield filecsv
+
+
+def get_file_hash(path):
+    """SHA-1 hash of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ResultStore:
+    """Results of contextual_matching per table for incremental re-annotation.
+
+    For each table, the folder directory contains a manifest <filename>.json with the
+    hash of the CSV-file and of the bbw configuration, and <filename>.pkl with the
+    entries of cpa_list, cea_list and nomatch for this table. get() returns the stored
+    entries only if neither the table nor the configuration have changed since put().
+    """
+
+    def __init__(self, directory, config=None):
+        self.directory = directory
+        self.config = hashlib.sha1(json.dumps(config or {}, sort_keys=True).encode('utf-8')).hexdigest()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, filename, extension):
+        return os.path.join(self.directory, filename + extension)
+
+    def get(self, filename, path):
+        """Stored [cpa_list, cea_list, nomatch] of an unchanged table or None."""
+        try:
+            with open(self._path(filename, '.json')) as f:
+                manifest = json.load(f)
+            if manifest.get('config') != self.config or manifest.get('hash') != get_file_hash(path):
+                return None
+            with open(self._path(filename, '.pkl'), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def put(self, filename, path, cpa_list, cea_list, nomatch):
+        """Store the entries of a table from cpa_list, cea_list and nomatch."""
+        with open(self._path(filename, '.pkl'), 'wb') as f:
+            pickle.dump([[k for k in cpa_list if k[0] == filename], [k for k in cea_list if k[0] == filename],
+                         [k for k in nomatch if k[0] == filename]], f)
+        with open(self._path(filename, '.json'), 'w') as f:
+            json.dump({'hash': get_file_hash(path), 'config': self.config}, f)
+
+
 def contextual_matching(filecsv, filename='', language='', semtab = False,
                         default_cpa=None, default_cea=None, default_nomatch=None,
-                        step3=False, step4=False, step5=True, step6=True, url=url_front):
+                        step3=False, step4=False, step5=True, step6=True, url=url_front, budget=None,
+                        deferred=None, provider=None, progress=None, workers=1, sample=None, min_accuracy=0.9):
     """Five-steps contextual matching for an input dataframe filecsv.
     Step 2 is always executed. Steps 3-6 are optional.
     The lists cpa_list and cea_list with annotations are returned.
     If semtab=True, a property must have URL at www.wikidata.org and col0=1.
     If semtab=False, a property may have URL at www.w3.org and col0=0.
+    If a Budget is given, the queries of steps 3-6 are skipped once it is exhausted
+    and the skipped rows are recorded in budget.skipped.
+    If DeferredSteps are given, steps 5 and 6 only collect the unmatched cells
+    which are resolved later by deferred.resolve().
+    All queries to the knowledge graph go through the provider, by default a WikidataProvider
+    with the Wikibase frontend url. If a provider is given, its url_front is used instead of url.
+    If progress is given, it is called as progress(step, done, total) after each processed row.
+    With workers > 1, the rows of step 2 are looked up and matched in a pool of threads.
+    With sample=n, step 2 looks up the first n rows without constraints and the other rows with
+    queries constrained to the type of the main column and the properties found in the sample,
+    if the accuracy check of the ConstrainedLookup with min_accuracy passes.
     """
     if semtab:
         col0 = 1
@@ -844,93 +1926,83 @@ def contextual_matching(filecsv, filename='', language='', semtab = False,
         nomatch = default_nomatch
     else:
         nomatch = []
+    if not provider:
+        provider = WikidataProvider(url_front=url)
+    url = provider.url_front
+    timeout_controller.start_table()
+    current_budget.set(None)
+    if budget:
+        budget.start_table()
     (rows, cols) = filecsv.shape
     nomatch_row = []
-    fullymatched_rows = []
+    fullymatched_rows = set()
     cpa_ind = len(cpa_list)
     cea_ind = len(cea_list)
     # STEP 2 in the workflow
     step2 = True  # Step 2 is always executed
     if step2:
-        for row in range(1, rows):  # We start here from row=1, because there are "col0" and "col1" in row=0
-            name_in_data = filecsv.iloc[row, 0]
-            [WDdf, how_matched, proper_name] = lookup(name_in_data, language)  # Lookup using the value from the 0-column
-            this_row_item = []
-            matches_per_row = 0
-            cpa_row_ind = len(cpa_list)
-            # for each other column look for a match of the value within the wikidata dataframe
-            if isinstance(WDdf, pd.DataFrame):
-                if not WDdf.empty:
-                    for col in range(col0, cols):
-                        try:
-                            df = match(WDdf, filecsv.iloc[row, col])
-                            if semtab:
-                                df_prop = df[(df.p2.str.contains(url)) & (
-                                    ~df.item.str.contains('/statement/'))]
-                            else:
-                                df_prop = df
-                            properties = [
-                                x.replace("/prop/P", "/prop/direct/P").replace("/direct-normalized/", "/direct/") for x
-                                in df_prop.p2.to_list()]
-                            properties = list(set(zip(properties, df_prop.item.to_list())))
-                            if len(properties) > 0:
-                                matches_per_row += 1
-                                if matches_per_row == cols - 1:
-                                    fullymatched_rows.append(row)
-                            item = list(set(df_prop.item.to_list()))
-                            if 'itemType' in df_prop:
-                                itemType = list(set([k for k in df_prop.itemType.to_list() if k is not np.nan]))
-                            else:
-                                itemType = []
-                            df_value = df[
-                                (~df.value.str.contains('/statement/')) & (df.value.str.contains(url))]
-                            if not df_value.empty:
-                                value, valueType = list(set(df_value.value.to_list())), list(
-                                    set([k for k in df_value.valueType.to_list() if k is not np.nan]))
-                            else:
-                                value, valueType = [], []
-                            if properties and item:
-                                cpa_list.append(
-                                    [filename, row, 0, col, properties, item, itemType, how_matched, proper_name])
-                            if item:
-                                cea_list.append([filename, row, 0, item, itemType, how_matched, proper_name])
-                                this_row_item.extend(item)
-                            if value:
-                                cea_list.append(
-                                    [filename, row, col, value, valueType, 'Step 2: ' + how_matched, proper_name])
-                        except Exception:
-                            pass
-            else:
-                nomatch.append([filename, row, name_in_data, proper_name])
-            # Take the most possible item for this row and remove the properties which are not taken from this item
-            if len(this_row_item) > 0:
-                this_row_item = Counter(this_row_item).most_common(1)[0][0]
-                for i, cpa_row in enumerate(cpa_list[cpa_row_ind:]):
-                    if len(cpa_row[4]) > 0:
-                        cpa_list[cpa_row_ind + i][4] = [prop for prop in cpa_row[4] if prop[1] == this_row_item]
-            # Define the unannotated rows
-            if row == rows - 1:  # After the last row
-                nomatch_row = [r for r in range(1, rows) if r not in fullymatched_rows]
+        row_range = range(1, rows)  # We start here from row=1, because there are "col0" and "col1" in row=0
+        constraints = ConstrainedLookup(provider, language, min_accuracy) if sample and rows - 1 > sample else None
+        matched_rows = match_rows(filecsv, row_range, filename, language, col0, semtab, provider, workers,
+                                  constraints, sample)
+        # The rows are merged in their order, so the lists are the same as for the sequential run
+        for row, [cpa_row, cea_row, nomatch_entry, fullymatched] in zip(row_range, matched_rows):
+            cpa_list.extend(cpa_row)
+            cea_list.extend(cea_row)
+            nomatch.extend(nomatch_entry)
+            if fullymatched:
+                fullymatched_rows.add(row)
+            if progress:
+                progress('Step 2', row, rows - 1)
+        matched_rows.close()
+        # Define the unannotated rows
+        nomatch_row = [r for r in range(1, rows) if r not in fullymatched_rows]
+    stats = ColumnStats()
+    stats.add(cpa_list[cpa_ind:], cea_list[cea_ind:])
+    match_unmatched_rows(filecsv, filename, language, nomatch_row, stats, cpa_list, cea_list, col0=col0, semtab=semtab,
+                         step3=step3, step4=step4, step5=step5, step6=step6, budget=budget, deferred=deferred,
+                         provider=provider, progress=progress, workers=workers)
+    return [cpa_list, cea_list, nomatch]
+
+
+def match_unmatched_rows(filecsv, filename, language, nomatch_row, stats, cpa_list, cea_list, col0=0, semtab=False,
+                         step3=False, step4=False, step5=True, step6=True, budget=None, deferred=None, provider=None,
+                         progress=None, workers=1, prop_chunksize=20):
+    """Steps 3-6 of the contextual matching for the rows nomatch_row of filecsv, which are not fully matched
+    in step 2. The columns are described by stats, the ColumnStats of the step-2 annotations.
+    The annotations are appended to cpa_list and cea_list.
+    Step 3 asks for prop_chunksize rows in one query.
+    With workers > 1, the distinct tail values of step 4 are looked up in a pool of threads."""
+    url = provider.url_front
+    cols = filecsv.shape[1]
+    cea_ind = len(cea_list)
     # Choose only entity columns, not the literal columns
-    entity_columns = list(set([k[2] for k in cea_list[cea_ind:] if k[2] != 0 and k[3]]))
+    entity_columns = stats.get_entity_columns()
 
     # STEP 3 in the workflow
     if step3:
         # MATCHING item,itemType,value and valueType via properties and values in the entity-columns
         # Calculate the properties and find the item, itemType, value and valueType:
-        col_prop = {}
-        for row_prop in cpa_list[cpa_ind:]:
-            if len(row_prop[4]) > 0:
-                if col_prop.get(row_prop[3]):
-                    col_prop[row_prop[3]].extend([cprop[0].split('/')[-1] for cprop in row_prop[4]])
-                else:
-                    col_prop[row_prop[3]] = [cprop[0].split('/')[-1] for cprop in row_prop[4]]
-        col_prop.update((key, Counter(value).most_common(1)[0][0]) for key, value in col_prop.items())
+        col_prop = stats.get_column_properties()
         if len(entity_columns) > 0:
-            for nrow in nomatch_row or []:
+            # The query is the same for all rows except of the values, so it is sent for chunks of rows at once
+            WDdfs = {}
+            for i in range(0, len(nomatch_row or []), prop_chunksize):
+                chunk = nomatch_row[i:i + prop_chunksize]
+                if budget and not budget.allows('prop_batch'):
+                    budget.skip(filename, chunk, 3)
+                    continue
                 try:  # Try to use ALL entity columns AT ONCE and their property-relations to the main column
-                    WDdf = get_SPARQL_dataframe_prop(prop=[col_prop[ncol] for ncol in entity_columns],
-                                                     value=[filecsv.iloc[nrow, ncol] for ncol in entity_columns])
+                    WDdfs.update(zip(chunk, provider.get_SPARQL_dataframe_prop_batch(
+                        prop=[col_prop[ncol] for ncol in entity_columns],
+                        values=[[filecsv.iloc[nrow, ncol] for ncol in entity_columns] for nrow in chunk])))
+                except Exception:
+                    pass
+            for n, nrow in enumerate(nomatch_row or []):
+                if progress:
+                    progress('Step 3', n, len(nomatch_row))
+                try:
+                    WDdf = WDdfs[nrow]
                     bestname = list(set(
                         difflib.get_close_matches(filecsv.iloc[nrow, 0], WDdf.itemLabel.to_list(), n=3, cutoff=0.81)))
                     WD = WDdf[WDdf.itemLabel.isin(bestname)]
@@ -961,12 +2033,23 @@ def contextual_matching(filecsv, filename='', language='', semtab = False,
     # STEP 4 in the workflow
     if step4:
         # # MATCHING via the tail-entity-label and main-column-label
-        for row in nomatch_row or []:
+        # The entity columns repeat their values (countries, genres, ...), so each distinct value is looked up once
+        tail_values = [filecsv.iloc[row, col] for row in nomatch_row or [] for col in entity_columns or []]
+        tail_values = [value for value in tail_values
+                       if not isfloat(value) and not re.match(r"^(\d{4})/(\d{2})/(\d{2})$", value)]
+        tail_items = get_tail_items(tail_values, language, provider, budget=budget, workers=workers)
+        missing = set(tail_values) - set(tail_items)  # not looked up, because the budget is exhausted
+        for n, row in enumerate(nomatch_row or []):
+            if progress:
+                progress('Step 4', n, len(nomatch_row))
+            if missing and any(filecsv.iloc[row, col] in missing for col in entity_columns):
+                budget.skip(filename, [row], 4)
+                continue
             for col in entity_columns or []:
                 value_to_match = filecsv.iloc[row, col]
                 if not isfloat(value_to_match) and not re.match(r"^(\d{4})/(\d{2})/(\d{2})$", value_to_match):
                     try:
-                        WDitem = get_SPARQL_dataframe_item(value_to_match, language)
+                        WDitem = tail_items[value_to_match]
                         bestname = difflib.get_close_matches(filecsv.iloc[row, 0], WDitem.itemLabel.to_list(), n=2,
                                                              cutoff=0.95)
                         if len(bestname) == 0:
@@ -1003,23 +2086,27 @@ def contextual_matching(filecsv, filename='', language='', semtab = False,
     # MATCHING via column types in Steps 5 and 6
     if step5 or step6:
         # Estimate the types of columns in this table
-        col_type = {}
-        for row_type in cea_list[cea_ind:]:
-            if len(row_type[4]) > 0:
-                if col_type.get(row_type[2]):
-                    col_type[row_type[2]].extend([etype.split('/')[-1] for etype in row_type[4]])
-                else:
-                    col_type[row_type[2]] = [etype.split('/')[-1] for etype in row_type[4]]
-        col_type.update((key, [ct[0] for ct in Counter(value).most_common(2)]) for key, value in col_type.items())
+        stats.add([], cea_list[cea_ind:])
+        col_type = stats.get_column_types()
+        if deferred:
+            # Steps 5 and 6 are resolved later for all tables at once
+            deferred.add(filecsv, filename, language, nomatch_row, entity_columns, col_type, col0, semtab,
+                         step5=step5, step6=step6)
+            step5, step6 = False, False
 
     # STEP 5 in the workflow
     if step5:
         # We match tail-entities using its type and itemLabel.
-        for nrow in nomatch_row or []:
+        for n, nrow in enumerate(nomatch_row or []):
+            if progress:
+                progress('Step 5', n, len(nomatch_row))
+            if budget and entity_columns and not budget.allows('type'):
+                budget.skip(filename, [nrow], 5)
+                continue
             for ncol in entity_columns or []:
                 try:
                     for column_type in col_type[ncol]:
-                        WDtype = get_SPARQL_dataframe_type(filecsv.iloc[nrow, ncol], column_type, language)
+                        WDtype = provider.get_SPARQL_dataframe_type(filecsv.iloc[nrow, ncol], column_type, language)
                         item = list(set(WDtype.item.to_list()))
                         if item:
                             cea_list.append(
@@ -1033,89 +2120,607 @@ def contextual_matching(filecsv, filename='', language='', semtab = False,
         # We match entities in the main column using its datatype
         if col_type.get(0) and len(nomatch_row) > 0:
             for column_type in col_type.get(0):
+                if budget and not budget.allows('type2'):
+                    budget.skip(filename, nomatch_row, 6)
+                    break
                 try:
-                    WDtype = get_SPARQL_dataframe_type2(column_type, language)
-                    for row in nomatch_row or []:
-                        proper_name = difflib.get_close_matches(filecsv.iloc[row, 0], WDtype.itemLabel.to_list(), n=15,
-                                                                cutoff=0.95)
-                        if len(proper_name) == 0:
-                            proper_name = difflib.get_close_matches(filecsv.iloc[row, 0], WDtype.itemLabel.to_list(),
-                                                                    n=15, cutoff=0.9)
-                            if len(proper_name) == 0:
-                                proper_name = difflib.get_close_matches(filecsv.iloc[row, 0],
-                                                                        WDtype.itemLabel.to_list(), n=15, cutoff=0.8)
-                                if len(proper_name) == 0:
-                                    proper_name = difflib.get_close_matches(filecsv.iloc[row, 0],
-                                                                            WDtype.itemLabel.to_list(), n=15,
-                                                                            cutoff=0.7)
-                        this_row_item = []
-                        cpa_row_ind = len(cpa_list)
-                        if len(proper_name) > 0:
-                            test_list = []
-                            for proper in proper_name:
-                                e = get_SPARQL_dataframe(proper, language, extra='?itemLabel ')
-                                if isinstance(e, pd.DataFrame):
-                                    test_list.append(e)
-                            if len(test_list) > 0:
-                                WDdf = pd.concat(test_list)
-
-                            if isinstance(WDdf, pd.DataFrame):
-                                for col in range(col0, cols):
-                                    try:
-                                        df = match(WDdf, filecsv.iloc[row, col])
-                                        if semtab:
-                                            df_prop = df[df.p2.str.contains(url)]
-                                        else:
-                                            df_prop = df
-                                        properties = [
-                                            x.replace("/prop/P", "/prop/direct/P").replace("/direct-normalized/",
-                                                                                           "/direct/") for x in
-                                            df_prop.p2.to_list()]
-                                        properties = list(set(zip(properties, df_prop.item.to_list())))
-                                        item = list(set(df_prop.item.to_list()))
-                                        if 'itemType' in df_prop.columns:
-                                            itemType = list(
-                                                set([k for k in df_prop.itemType.to_list() if k is not np.nan]))
-                                        else:
-                                            itemType = []
-                                        df_value = df[(~df.value.str.contains('/statement/')) & (
-                                            df.value.str.contains(url))]
-                                        if not df_value.empty:
-                                            value, valueType = list(set(df_value.value.to_list())), list(
-                                                set([k for k in df_value.valueType.to_list() if k is not np.nan]))
-                                        else:
-                                            value, valueType = [], []
-                                        if properties and item:
-                                            cpa_list.append(
-                                                [filename, row, 0, col, properties, item, itemType, 'Step 6',
-                                                 list(set(df_prop.itemLabel.to_list()))])
-                                        if item:
-                                            cea_list.append([filename, row, 0, item, itemType, 'Step 6',
-                                                             list(set(df_prop.itemLabel.to_list()))])
-                                            this_row_item.extend(item)
-                                        if value:
-                                            cea_list.append([filename, row, col, value, valueType, 'Step 6',
-                                                             list(set(df_value.itemLabel.to_list()))])
-                                    except Exception:
-                                        pass
-                        # Take the most possible item for this row and remove the properties which are not taken from this item
-                        if len(this_row_item) > 0:
-                            this_row_item = Counter(this_row_item).most_common(1)[0][0]
-                            for i, cpa_row in enumerate(cpa_list[cpa_row_ind:]):
-                                if len(cpa_row[4]) > 0:
-                                    cpa_list[cpa_row_ind + i][4] = [prop for prop in cpa_row[4] if
-                                                                    prop[1] == this_row_item]
+                    WDtype = provider.get_SPARQL_dataframe_type2(column_type, language)
+                    labels = WDtype.itemLabel.to_list()
+                    for n, row in enumerate(nomatch_row or []):
+                        if progress:
+                            progress('Step 6', n, len(nomatch_row))
+                        if budget and not budget.allows('label'):
+                            budget.skip(filename, [row], 6)
+                            continue
+                        match_by_type(labels, filecsv.iloc[row].to_list(), filename, row, language, cpa_list, cea_list,
+                                      col0=col0, semtab=semtab, provider=provider)
                 except Exception:
                     pass
+    return [cpa_list, cea_list]
+
+
+def get_tail_items(values, language, provider, budget=None, workers=1):
+    """
+    Parameters
+    ----------
+    values : list
+        Tail values of step 4, each distinct value is looked up once.
+    language : str
+        Language of the values.
+    provider : WikidataProvider
+        Access to the knowledge graph.
+    budget : Budget, optional
+        Once it is exhausted, the remaining values are not looked up.
+    workers : int, optional
+        Number of values looked up at the same time. The default is 1.
+    Returns
+    -------
+    items : dict
+        provider.get_SPARQL_dataframe_item() for each value which is looked up.
+    """
+    values = list(dict.fromkeys(values))
+    items = {}
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 and len(values) > 1 else None
+    try:
+        # The budget is checked before each batch of workers values
+        for i in range(0, len(values), max(workers, 1)):
+            if budget and not budget.allows('item'):
+                break
+            batch = values[i:i + max(workers, 1)]
+            lookup = in_context(lambda value: provider.get_SPARQL_dataframe_item(value, language))
+            items.update(zip(batch, executor.map(lookup, batch) if executor else map(lookup, batch)))
+    finally:
+        if executor:
+            executor.shutdown()
+    return items
+
+
+def read_table_windows(path, chunksize=1000):
+    """Read a CSV-file in windows of chunksize rows and preprocess each window.
+    The windows keep the row numbers of the file in their index."""
+    for window in pd.read_csv(path, dtype=str, header=None, chunksize=chunksize):
+        yield preprocessing(window)
+
+
+def contextual_matching_chunked(windows, filename='', language='', semtab=False,
+                                default_cpa=None, default_cea=None, default_nomatch=None,
+                                step3=False, step4=False, step5=True, step6=True, budget=None,
+                                deferred=None, provider=None, progress=None, workers=1, sample=None,
+                                min_accuracy=0.9):
+    """Contextual matching of a large table given as an iterable of row windows,
+    e.g. read_table_windows(path) or pd.read_csv(path, dtype=str, header=None, chunksize=...).
+    The first window starts with the header row. The windows must be preprocessed.
+    Step 2 is executed window by window. Between the windows only the annotations, the
+    ColumnStats and the rows which are not fully matched are kept, so the memory for the
+    table and the lookup results is bounded by the window size. Steps 3-6 run afterwards
+    on the kept rows. The lists cpa_list, cea_list and nomatch are the same as returned
+    by contextual_matching() for the whole table. In step 2, progress is called with
+    total=None, because the number of rows is not known in advance. With sample=n, the
+    sample of the constrained lookups is taken from the first window. As in contextual_matching(),
+    the constraints are only used if there are more than n rows, i.e. in the first window.
+    """
+    col0 = 1 if semtab else 0
+    cpa_list = default_cpa if default_cpa else []
+    cea_list = default_cea if default_cea else []
+    nomatch = default_nomatch if default_nomatch else []
+    if not provider:
+        provider = WikidataProvider()
+    timeout_controller.start_table()
+    current_budget.set(None)
+    if budget:
+        budget.start_table()
+    stats = ColumnStats()
+    constraints = None
+    kept = []  # The header and the rows which are not fully matched in step 2
+    row_numbers = []  # The row numbers of the kept rows in the table
+    offset = 0
+    for window in windows:
+        first = 1 if offset == 0 else 0  # The header is not matched
+        if first:
+            kept.append(window.iloc[0].to_list())
+            row_numbers.append(0)
+            if sample and len(window) - 1 > sample:
+                constraints = ConstrainedLookup(provider, language, min_accuracy)
+        window_rows = range(first, len(window))
+        matched_rows = list(match_rows(window, window_rows, filename, language, col0, semtab, provider, workers,
+                                       constraints, sample))
+        for row, [cpa_row, cea_row, nomatch_entry, fullymatched] in zip(window_rows, matched_rows):
+            for annotation in cpa_row + cea_row + nomatch_entry:
+                annotation[1] = offset + row
+            cpa_list.extend(cpa_row)
+            cea_list.extend(cea_row)
+            nomatch.extend(nomatch_entry)
+            stats.add(cpa_row, cea_row)
+            if not fullymatched:
+                kept.append(window.iloc[row].to_list())
+                row_numbers.append(offset + row)
+            if progress:
+                progress('Step 2', offset + row, None)
+        offset += len(window)
+        del matched_rows
+    if len(kept) < 2:
+        return [cpa_list, cea_list, nomatch]
+    # Steps 3-6 on the kept rows, their positions are mapped back to the row numbers afterwards
+    rest = pd.DataFrame(kept)
+    del kept
+    cpa_ind, cea_ind = len(cpa_list), len(cea_list)
+    skipped_ind = len(budget.skipped) if budget else 0
+    cells_ind, rows_ind = (len(deferred.cells), len(deferred.rows)) if deferred else (0, 0)
+    match_unmatched_rows(rest, filename, language, list(range(1, len(rest))), stats, cpa_list, cea_list,
+                         col0=col0, semtab=semtab, step3=step3, step4=step4, step5=step5, step6=step6,
+                         budget=budget, deferred=deferred, provider=provider, progress=progress, workers=workers)
+    added = cpa_list[cpa_ind:] + cea_list[cea_ind:]
+    if budget:
+        added += budget.skipped[skipped_ind:]
+    if deferred:
+        added += deferred.cells[cells_ind:] + deferred.rows[rows_ind:]
+    for annotation in added:
+        annotation[1] = row_numbers[annotation[1]]
     return [cpa_list, cea_list, nomatch]
 
 
-def postprocessing(cpa_list, cea_list, filelist=None, target_cpa=None, target_cea=None, target_cta=None, gui=False):
+class ConstrainedLookup:
+    """Sample-then-constrain lookups for step 2 of long homogeneous tables.
+
+    The rows of a sample are looked up without constraints. check() takes the type of the
+    main column (as steps 5 and 6) and the properties (as step 3) from their annotations
+    and looks the sample up again with queries constrained to them. Only if at least
+    min_accuracy of the annotated sample rows get the same main-column item and the same
+    items in the other columns, lookups() resolves the other rows with the constrained
+    queries, chunksize distinct values per query. The rows without a constrained match and
+    the rows which miss a match in a column matched in the sample (e.g. by a property which
+    is not in the sample) are looked up without constraints by match_rows().
+    """
+
+    def __init__(self, provider, language='', min_accuracy=0.9, chunksize=50):
+        self.provider = provider
+        self.language = language
+        self.min_accuracy = min_accuracy
+        self.chunksize = chunksize
+        self.checked = False
+        self.accepted = False
+        self.accuracy = None
+        self.datatype = None
+        self.properties = []
+        self.columns = set()  # the columns with a CPA-annotation in the sample
+
+    @staticmethod
+    def main_item(cea_rows):
+        """The most frequent main-column item in the CEA-annotations of a row or None."""
+        items = Counter([item for cea_row in cea_rows if cea_row[2] == 0 for item in cea_row[3]])
+        return items.most_common(1)[0][0] if items else None
+
+    @staticmethod
+    def cells(cea_rows):
+        """The items of the other columns in the CEA-annotations of a row, by column."""
+        cells = {}
+        for cea_row in cea_rows:
+            if cea_row[2] != 0:
+                cells.setdefault(cea_row[2], set()).update(cea_row[3])
+        return cells
+
+    def complete(self, matched):
+        """True if the result of match_row() for a row has a CPA-annotation in each column which
+        has one in the sample, i.e. it does not need the lookup without constraints."""
+        return self.columns <= set([cpa_row[3] for cpa_row in matched[0]])
+
+    def check(self, filecsv, rows, sampled, filename='', col0=0, semtab=False):
+        """Infer the constraints from the results of match_row() for the sample rows and check them.
+        Returns True if they are accepted for the other rows."""
+        self.checked = True
+        stats = ColumnStats()
+        for [cpa_row, cea_row, nomatch, fullymatched] in sampled:
+            stats.add(cpa_row, cea_row)
+        types = stats.get_column_types().get(0)
+        self.properties = sorted(set([prop for [cpa_row, cea_row, nomatch, fullymatched] in sampled
+                                      for cpa in cpa_row for (prop, item) in cpa[4]]))
+        self.columns = set([cpa[3] for [cpa_row, cea_row, nomatch, fullymatched] in sampled for cpa in cpa_row])
+        if not types or not self.properties:
+            return False
+        self.datatype = types[0]
+        if not self.language:
+            self.language = get_table_language(filecsv)
+        lookups = self._lookups(filecsv, rows)
+        correct, total = 0, 0
+        for row, [cpa_row, cea_row, nomatch, fullymatched] in zip(rows, sampled):
+            item = self.main_item(cea_row)
+            if item is None:
+                continue
+            total += 1
+            if row in lookups:
+                constrained = match_row(filecsv, row, filename, self.language, col0, semtab, self.provider, lookups[row])
+                correct += self.main_item(constrained[1]) == item and self.cells(constrained[1]) == self.cells(cea_row)
+        self.accuracy = correct / total if total else 0.0
+        self.accepted = self.accuracy >= self.min_accuracy
+        return self.accepted
+
+    def lookups(self, filecsv, rows):
+        """The constrained lookups [WDdf, 'Constrained', name] of the rows with a match, as a dictionary
+        for match_rows(). It is empty, if the constraints are not accepted."""
+        if not self.accepted:
+            return {}
+        return self._lookups(filecsv, rows)
+
+    def _lookups(self, filecsv, rows):
+        names = {row: filecsv.iloc[row, 0] for row in rows}
+        distinct = [name for name in dict.fromkeys(names.values()) if isinstance(name, str) and name]
+        frames = {}
+        for i in range(0, len(distinct), self.chunksize):
+            df = self.provider.get_SPARQL_dataframe_constrained(distinct[i:i + self.chunksize], self.datatype,
+                                                                self.properties, self.language)
+            if df is not None:
+                for name, group in df.groupby('name', sort=False):
+                    frames[name] = group.drop(columns=['name']).dropna(axis=1, how='all').reset_index(drop=True)
+        return {row: [frames[name], 'Constrained', name] for row, name in names.items() if name in frames}
+
+
+def match_rows(filecsv, row_range, filename, language, col0, semtab, provider, workers=1, constraints=None,
+               sample=None):
+    """Step 2 for the rows of row_range, yielding the results of match_row() in the order of the rows.
+    With workers > 1, the rows are looked up and matched in a pool of threads. With ConstrainedLookup
+    constraints which are not checked yet, the first sample rows are matched first and check the
+    constraints, which are then used for the other rows. A row which is not complete with its
+    constrained lookup (ConstrainedLookup.complete()) is matched again with the lookup of the provider."""
+    lookups = {}
+    if constraints and sample and not constraints.checked:
+        sampled = list(match_rows(filecsv, row_range[:sample], filename, language, col0, semtab, provider, workers))
+        constraints.check(filecsv, row_range[:sample], sampled, filename, col0, semtab)
+        yield from sampled
+        row_range = row_range[sample:]
+        lookups = constraints.lookups(filecsv, row_range)
+    elif constraints:
+        lookups = constraints.lookups(filecsv, row_range)
+
+    def match_one(row):
+        matched = match_row(filecsv, row, filename, language, col0, semtab, provider, lookups.get(row))
+        if row in lookups and not constraints.complete(matched):
+            matched = match_row(filecsv, row, filename, language, col0, semtab, provider)
+        return matched
+
+    if workers > 1 and len(row_range) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(in_context(match_one), row_range)
+    else:
+        for row in row_range:
+            yield match_one(row)
+
+
+def match_row(filecsv, row, filename, language, col0, semtab, provider, lookup=None):
+    """Step 2 for one row: lookup the value from the 0-column and match the other columns
+    within the Wikidata dataframe. A lookup [WDdf, how_matched, proper_name] may be given,
+    e.g. by a ConstrainedLookup.
+    Returns [cpa_row, cea_row, nomatch_row, fullymatched] with the annotations of this row,
+    the row for the nomatch-list and if all columns are matched."""
+    url = provider.url_front
+    (rows, cols) = filecsv.shape
+    cpa_list, cea_list, nomatch = [], [], []
+    name_in_data = filecsv.iloc[row, 0]
+    projected = None
+    if provider.projection and not lookup:
+        values = [value for value in filecsv.iloc[row, col0:cols] if isinstance(value, str) and value]
+        projected = provider.lookup_projected(name_in_data, language, values)
+    if lookup:
+        [WDdf, how_matched, proper_name] = lookup
+        complete = WDdf
+    elif projected and isinstance(projected[0], pd.DataFrame):
+        [WDdf, how_matched, proper_name] = projected
+        complete = None  # all claims are looked up only for a value without an exact match in the projected claims
+    else:
+        [WDdf, how_matched, proper_name] = provider.lookup(name_in_data, language)  # Lookup using the value from the 0-column
+        complete = WDdf
+    this_row_item = []
+    matches_per_row = 0
+    fullymatched = False
+    # for each other column look for a match of the value within the wikidata dataframe
+    if isinstance(WDdf, pd.DataFrame):
+        if not WDdf.empty:
+            for col in range(col0, cols):
+                try:
+                    if complete is None:
+                        df = match_exact(WDdf, filecsv.iloc[row, col])
+                        if df.empty:
+                            complete = provider.lookup(name_in_data, language)[0]
+                            if not isinstance(complete, pd.DataFrame):
+                                complete = WDdf.iloc[0:0]
+                    if complete is not None:
+                        df = match(complete, filecsv.iloc[row, col])
+                    if semtab:
+                        df_prop = df[(df.p2.str.contains(url)) & (
+                            ~df.item.str.contains('/statement/'))]
+                    else:
+                        df_prop = df
+                    properties = [
+                        x.replace("/prop/P", "/prop/direct/P").replace("/direct-normalized/", "/direct/") for x
+                        in df_prop.p2.to_list()]
+                    properties = list(set(zip(properties, df_prop.item.to_list())))
+                    if len(properties) > 0:
+                        matches_per_row += 1
+                        if matches_per_row == cols - 1:
+                            fullymatched = True
+                    item = list(set(df_prop.item.to_list()))
+                    if 'itemType' in df_prop:
+                        itemType = list(set([k for k in df_prop.itemType.to_list() if k is not np.nan]))
+                    else:
+                        itemType = []
+                    df_value = df[
+                        (~df.value.str.contains('/statement/')) & (df.value.str.contains(url))]
+                    if not df_value.empty:
+                        value, valueType = list(set(df_value.value.to_list())), list(
+                            set([k for k in df_value.valueType.to_list() if k is not np.nan]))
+                    else:
+                        value, valueType = [], []
+                    if properties and item:
+                        cpa_list.append(
+                            [filename, row, 0, col, properties, item, itemType, how_matched, proper_name])
+                    if item:
+                        cea_list.append([filename, row, 0, item, itemType, how_matched, proper_name])
+                        this_row_item.extend(item)
+                    if value:
+                        cea_list.append(
+                            [filename, row, col, value, valueType, 'Step 2: ' + how_matched, proper_name])
+                except Exception:
+                    pass
+    else:
+        nomatch.append([filename, row, name_in_data, proper_name])
+    # Take the most possible item for this row and remove the properties which are not taken from this item
+    if len(this_row_item) > 0:
+        this_row_item = Counter(this_row_item).most_common(1)[0][0]
+        for cpa_row in cpa_list:
+            if len(cpa_row[4]) > 0:
+                cpa_row[4] = [prop for prop in cpa_row[4] if prop[1] == this_row_item]
+    return [cpa_list, cea_list, nomatch, fullymatched]
+
+
+class ColumnStats:
+    """Aggregates of the annotations per column, which steps 3-6 use instead of the whole lists:
+    the entity columns, the properties (step 3) and the types (steps 5 and 6) of each column."""
+
+    def __init__(self):
+        self.entity_columns = set()
+        self.properties = {}  # column: Counter of the PIDs
+        self.types = {}  # column: Counter of the QIDs
+
+    def add(self, cpa_rows, cea_rows):
+        for row_prop in cpa_rows:
+            if len(row_prop[4]) > 0:
+                self.properties.setdefault(row_prop[3], Counter()).update(
+                    [cprop[0].split('/')[-1] for cprop in row_prop[4]])
+        for row_type in cea_rows:
+            if row_type[2] != 0 and row_type[3]:
+                self.entity_columns.add(row_type[2])
+            if len(row_type[4]) > 0:
+                self.types.setdefault(row_type[2], Counter()).update([etype.split('/')[-1] for etype in row_type[4]])
+
+    def get_entity_columns(self):
+        return list(self.entity_columns)
+
+    def get_column_properties(self):
+        """The most frequent property (PID) per column."""
+        return {col: counter.most_common(1)[0][0] for col, counter in self.properties.items()}
+
+    def get_column_types(self):
+        """The two most frequent types (QIDs) per column, estimated from the itemTypes of the CEA-annotations."""
+        return {col: [ct[0] for ct in counter.most_common(2)] for col, counter in self.types.items()}
+
+
+def match_by_type(labels, values, filename, row, language, cpa_list, cea_list, col0=0, semtab=False, provider=None):
+    """Step 6 for a single row: the main-column value values[0] is matched to the labels of the items
+    with the column type, and the items are matched to the other values of the row.
+    The annotations are appended to cpa_list and cea_list."""
+    if not provider:
+        provider = WikidataProvider()
+    url = provider.url_front
+    try:
+        proper_name = difflib.get_close_matches(values[0], labels, n=15, cutoff=0.95)
+        if len(proper_name) == 0:
+            proper_name = difflib.get_close_matches(values[0], labels, n=15, cutoff=0.9)
+            if len(proper_name) == 0:
+                proper_name = difflib.get_close_matches(values[0], labels, n=15, cutoff=0.8)
+                if len(proper_name) == 0:
+                    proper_name = difflib.get_close_matches(values[0], labels, n=15, cutoff=0.7)
+    except Exception:
+        return
+    this_row_item = []
+    cpa_row_ind = len(cpa_list)
+    if len(proper_name) > 0:
+        WDdf = None
+        test_list = []
+        for proper in proper_name:
+            e = provider.get_SPARQL_dataframe(proper, language, extra='?itemLabel ')
+            if isinstance(e, pd.DataFrame):
+                test_list.append(e)
+        if len(test_list) > 0:
+            WDdf = pd.concat(test_list)
+
+        if isinstance(WDdf, pd.DataFrame):
+            for col in range(col0, len(values)):
+                try:
+                    df = match(WDdf, values[col])
+                    if semtab:
+                        df_prop = df[df.p2.str.contains(url)]
+                    else:
+                        df_prop = df
+                    properties = [
+                        x.replace("/prop/P", "/prop/direct/P").replace("/direct-normalized/", "/direct/") for x in
+                        df_prop.p2.to_list()]
+                    properties = list(set(zip(properties, df_prop.item.to_list())))
+                    item = list(set(df_prop.item.to_list()))
+                    if 'itemType' in df_prop.columns:
+                        itemType = list(set([k for k in df_prop.itemType.to_list() if k is not np.nan]))
+                    else:
+                        itemType = []
+                    df_value = df[(~df.value.str.contains('/statement/')) & (df.value.str.contains(url))]
+                    if not df_value.empty:
+                        value, valueType = list(set(df_value.value.to_list())), list(
+                            set([k for k in df_value.valueType.to_list() if k is not np.nan]))
+                    else:
+                        value, valueType = [], []
+                    if properties and item:
+                        cpa_list.append([filename, row, 0, col, properties, item, itemType, 'Step 6',
+                                         list(set(df_prop.itemLabel.to_list()))])
+                    if item:
+                        cea_list.append([filename, row, 0, item, itemType, 'Step 6',
+                                         list(set(df_prop.itemLabel.to_list()))])
+                        this_row_item.extend(item)
+                    if value:
+                        cea_list.append([filename, row, col, value, valueType, 'Step 6',
+                                         list(set(df_value.itemLabel.to_list()))])
+                except Exception:
+                    pass
+    # Take the most possible item for this row and remove the properties which are not taken from this item
+    if len(this_row_item) > 0:
+        this_row_item = Counter(this_row_item).most_common(1)[0][0]
+        for i, cpa_row in enumerate(cpa_list[cpa_row_ind:]):
+            if len(cpa_row[4]) > 0:
+                cpa_list[cpa_row_ind + i][4] = [prop for prop in cpa_row[4] if prop[1] == this_row_item]
+
+
+class DeferredSteps:
+    """Steps 5 and 6 deferred to a second pass over all tables.
+
+    contextual_matching(deferred=...) collects the unmatched cells of steps 5 and 6
+    instead of resolving them table by table. resolve() groups the cells of all
+    tables by (column type, language): step 5 uses one batched query per group and
+    chunk of labels, step 6 uses one class-label index per group. The indexes are
+    kept in class_labels and can be shared between several resolve() calls.
+    The queries go through the provider, by default a WikidataProvider.
+    """
+
+    def __init__(self, chunksize=50, provider=None):
+        self.chunksize = chunksize
+        self.provider = provider if provider else WikidataProvider()
+        self.cells = []  # Step 5: [filename, row, col, label, column_type, language]
+        self.rows = []  # Step 6: [filename, row, values, column_type, language, col0, semtab]
+        self.class_labels = {}  # (column_type, language): labels of the items with this type
+
+    def add(self, filecsv, filename, language, nomatch_row, entity_columns, col_type, col0=0, semtab=False,
+            step5=True, step6=True):
+        """Collect the unmatched cells of a table."""
+        if step5:
+            for nrow in nomatch_row or []:
+                for ncol in entity_columns or []:
+                    label = filecsv.iloc[nrow, ncol]
+                    lang = language if language else get_language(label)
+                    for column_type in col_type.get(ncol, []):
+                        self.cells.append([filename, nrow, ncol, label, column_type, lang])
+        if step6 and col_type.get(0):
+            for row in nomatch_row or []:
+                for column_type in col_type.get(0):
+                    self.rows.append([filename, row, filecsv.iloc[row].to_list(), column_type, language, col0,
+                                      semtab])
+
+    def resolve(self, cpa_list, cea_list):
+        """Resolve the collected cells and append the annotations to cpa_list and cea_list."""
+        # STEP 5: one query per (column type, language) and chunk of distinct labels
+        groups = {}
+        for [filename, nrow, ncol, label, column_type, lang] in self.cells:
+            groups.setdefault((column_type, lang), set()).add(label)
+        items = {}
+        for (column_type, lang), labels in groups.items():
+            labels = sorted(labels)
+            for i in range(0, len(labels), self.chunksize):
+                WDtype = self.provider.get_SPARQL_dataframe_type_batch(labels[i:i + self.chunksize], column_type, lang)
+                if isinstance(WDtype, pd.DataFrame):
+                    for name, df in WDtype.groupby('name'):
+                        items[(column_type, lang, name)] = [list(set(df.item.to_list())),
+                                                           list(set(df.itemLabel.to_list()))]
+        url = self.provider.url_front
+        for [filename, nrow, ncol, label, column_type, lang] in self.cells:
+            if items.get((column_type, lang, label)):
+                [item, itemLabel] = items.get((column_type, lang, label))
+                cea_list.append([filename, nrow, ncol, item, [url + "/entity/" + column_type], 'Step 5', itemLabel])
+        # STEP 6: one class-label index per (column type, language)
+        for [filename, row, values, column_type, language, col0, semtab] in self.rows:
+            key = (column_type, language if language else 'en')
+            if key not in self.class_labels:
+                WDtype = self.provider.get_SPARQL_dataframe_type2(column_type, language)
+                self.class_labels[key] = WDtype.itemLabel.to_list() if isinstance(WDtype, pd.DataFrame) else []
+            if self.class_labels[key]:
+                match_by_type(self.class_labels[key], values, filename, row, language, cpa_list, cea_list,
+                              col0=col0, semtab=semtab, provider=self.provider)
+        self.cells, self.rows = [], []
+        return [cpa_list, cea_list]
+
+
+target_columns = {'cpa': ['file', 'column0', 'column'], 'cea': ['file', 'row', 'column'], 'cta': ['file', 'column']}
+
+
+def create_targets_db(database, target_cpa, target_cea, target_cta, chunksize=10**6):
+    """
+    Parameters
+    ----------
+    database : str
+        Path to a new SQLite database.
+    target_cpa, target_cea, target_cta : str
+        Paths to the CSV-files with targets for CPA, CEA and CTA tasks.
+    chunksize : int, optional
+        The CSV-files are read in chunks of this number of lines.
+    Returns
+    -------
+    None. The targets are stored in the tables cpa, cea and cta indexed by file,
+    the sorted distinct files are stored in the table files.
+    """
+    with sqlite3.connect(database) as con:
+        for task, target in [('cpa', target_cpa), ('cea', target_cea), ('cta', target_cta)]:
+            con.execute('DROP TABLE IF EXISTS ' + task)
+            con.execute('CREATE TABLE ' + task + ' (' + ', '.join(
+                ['"' + column + '" TEXT' for column in target_columns[task]]) + ')')
+            for chunk in pd.read_csv(target, names=target_columns[task], dtype=object, chunksize=chunksize):
+                chunk.to_sql(task, con, if_exists='append', index=False)
+            con.execute('CREATE INDEX ' + task + '_file ON ' + task + ' (file)')
+        con.execute('DROP TABLE IF EXISTS files')
+        con.execute('CREATE TABLE files AS SELECT file FROM cpa UNION SELECT file FROM cea UNION SELECT file FROM cta '
+                    'ORDER BY file')
+
+
+def get_targets(database, offset=0, amount=None, only=None):
+    """
+    Parameters
+    ----------
+    database : str
+        Path to a SQLite database created by create_targets_db().
+    offset : int, optional
+        The number of files to skip in the sorted list of files.
+    amount : int, optional
+        The number of files. The default is all files after offset.
+    only : list, optional
+        Consider only these files.
+    Returns
+    -------
+    list
+        [filelist, target_cpa, target_cea, target_cta] for the slice of files.
+        Only the targets of these files are read from the database.
+    """
+    with sqlite3.connect(database) as con:
+        filelist = [file for (file,) in con.execute('SELECT file FROM files ORDER BY file')]
+        if only is not None:
+            only = set(only)
+            filelist = [file for file in filelist if file in only]
+        filelist = filelist[offset:] if amount is None else filelist[offset:offset + amount]
+        con.execute('CREATE TEMP TABLE slice (file TEXT PRIMARY KEY)')
+        con.executemany('INSERT INTO slice VALUES (?)', [(file,) for file in filelist])
+        targets = [pd.read_sql_query('SELECT ' + ', '.join(['t."' + column + '"' for column in target_columns[task]]) +
+                                     ' FROM ' + task + ' t JOIN slice USING (file)', con)
+                   for task in ['cpa', 'cea', 'cta']]
+    return [filelist] + targets
+
+
+def postprocessing(cpa_list, cea_list, filelist=None, target_cpa=None, target_cea=None, target_cta=None, gui=False,
+                   provider=None):
     """Postprocessing is performed for input lists cpa_list and cea_list.
     The target-dataframes are optional. If they are given,
-    only target-annotations are returned in """
+    only target-annotations are returned in 
+    The common class of two equally frequent column types is queried via the provider."""
     # Create dataframe using the non-matched names from the main column (0), the corresponding filename and row
     # nm = pd.DataFrame(nomatch)
+    # Select the targets of the files in filelist only once
+    if filelist:
+        if isinstance(target_cpa, pd.DataFrame):
+            target_cpa = target_cpa[target_cpa.file.isin(filelist)]
+        if isinstance(target_cea, pd.DataFrame):
+            target_cea = target_cea[target_cea.file.isin(filelist)]
+        if isinstance(target_cta, pd.DataFrame):
+            target_cta = target_cta[target_cta.file.isin(filelist)]
     # Create CPA-dataframe from the list and find the most frequent property
     bbw_cpa_few = pd.DataFrame(cpa_list, columns=['file', 'row', 'column0', 'column', 'property', 'item', 'itemType',
                                                   'how_matched', 'what_matched'])
@@ -1128,7 +2733,7 @@ def postprocessing(cpa_list, cea_list, filelist=None, target_cpa=None, target_ce
     # Keep only the target columns for CPA-challenge
     if filelist and isinstance(target_cpa, pd.DataFrame):
         bbw_cpa_sub = pd.merge(
-            target_cpa[target_cpa.file.isin(filelist)].astype({"file": str, "column0": int, "column": int}),
+            target_cpa.astype({"file": str, "column0": int, "column": int}),
             bbw_cpa_sub.astype({"file": str, "column0": int, "column": int, "property": str}),
             on=['file', 'column0', 'column'], how='inner')
     # Create CEA-dataframe from the list and drop rows with None or empty lists
@@ -1143,7 +2748,7 @@ def postprocessing(cpa_list, cea_list, filelist=None, target_cpa=None, target_ce
     # Keep only the target columns for CEA-challenge
     if filelist and isinstance(target_cea, pd.DataFrame):
         bbw_cea_sub = pd.merge(
-            target_cea[target_cea.file.isin(filelist)].astype({"file": str, "row": int, "column": int}),
+            target_cea.astype({"file": str, "row": int, "column": int}),
             bbw_cea_sub.astype({"file": str, "row": int, "column": int, "item": str}),
             on=['file', 'row', 'column'], how='inner')
     # Drop None-rows from bbw_few before getting itemType for CTA:
@@ -1154,24 +2759,24 @@ def postprocessing(cpa_list, cea_list, filelist=None, target_cpa=None, target_ce
     bbw_cta_one['itemType'] = bbw_cta_one['itemType'].apply(lambda x: [y for subx in x for y in subx])
     # bbw_cta_one['itemType'] = bbw_cta_one['itemType'].apply(lambda x: get_common_class(x) if len(x)>1 else x[0])
     bbw_cta_one['itemType'] = bbw_cta_one['itemType'].apply(lambda x: Counter(x).most_common(2))
-    bbw_cta_one['itemType'] = bbw_cta_one['itemType'].apply(lambda x: get_one_class(x))
+    bbw_cta_one['itemType'] = bbw_cta_one['itemType'].apply(lambda x: get_one_class(x, provider))
     bbw_cta_sub = bbw_cta_one.dropna()
     # Keep only the target columns for CTA-challenge
     if filelist and isinstance(target_cta, pd.DataFrame):
-        bbw_cta_sub = pd.merge(target_cta[target_cta.file.isin(filelist)].astype({"file": str, "column": int}),
+        bbw_cta_sub = pd.merge(target_cta.astype({"file": str, "column": int}),
                                bbw_cta_sub.astype({"file": str, "column": int, "itemType": str}),
                                on=['file', 'column'], how='inner')
     # Print statistics
     if filelist and not gui:
         stat_cpa_matched = len(bbw_cpa_sub)
         if isinstance(target_cpa, pd.DataFrame):
-            stat_cpa_target = len(target_cpa[target_cpa.file.isin(filelist)])
+            stat_cpa_target = len(target_cpa)
         stat_cea_matched = len(bbw_cea_sub)
         if isinstance(target_cea, pd.DataFrame):
-            stat_cea_target = len(target_cea[target_cea.file.isin(filelist)])
+            stat_cea_target = len(target_cea)
         stat_cta_matched = len(bbw_cta_sub)
         if isinstance(target_cta, pd.DataFrame):
-            stat_cta_target = len(target_cta[target_cta.file.isin(filelist)])
+            stat_cta_target = len(target_cta)
         print('\n*** Internal statistics ***')
         print('Task', 'Coverage', 'Matched', 'Total', 'Unmatched', sep='\t')
         try:
@@ -1192,7 +2797,7 @@ def postprocessing(cpa_list, cea_list, filelist=None, target_cpa=None, target_ce
     return [bbw_cpa_sub, bbw_cea_sub, bbw_cta_sub]
 
 
-def annotate(filecsv, filename='', language=''):
+def annotate(filecsv, filename='', language='', provider=None, progress=None, workers=1):
     """
     Parameters
     ----------
@@ -1200,6 +2805,12 @@ def annotate(filecsv, filename='', language=''):
         Input dataframe.
     filename : str
         A filename.
+    provider : WikidataProvider, optional
+        Access to the knowledge graph. The default is WikidataProvider().
+    progress : callable, optional
+        Called as progress(step, done, total) while the table is annotated.
+    workers : int
+        The number of threads looking up the rows in step 2. The default is 1.
     Returns
     -------
     list
@@ -1214,47 +2825,49 @@ def annotate(filecsv, filename='', language=''):
 
     """
     filename = filename.replace('.csv', '')
+    if not provider:
+        provider = WikidataProvider()
     filecsv = preprocessing(filecsv)
     [cpa, cea, nomatch] = contextual_matching(filecsv, filename, language,
                                               step3=False, step4=False, step5=True,
-                                              step6=True)
-    [cpa_sub, cea_sub, cta_sub] = postprocessing(cpa, cea, [filecsv], gui=True)
+                                              step6=True, provider=provider, progress=progress,
+                                              workers=workers)
+    if progress:
+        progress('Postprocessing', 0, 1)
+    [cpa_sub, cea_sub, cta_sub] = postprocessing(cpa, cea, [filecsv], gui=True, provider=provider)
+    if progress:
+        progress('Labels', 0, 1)
     bbwtable = filecsv
     urltable = pd.DataFrame(columns=filecsv.columns)
     labeltable = pd.DataFrame(columns=filecsv.columns)
-    if not cea_sub.empty:
-        for row in set(cea_sub.row.to_list()) or []:
-            for column in set(cea_sub.column.to_list()) or []:
-                try:
-                    link = cea_sub.item[(cea_sub.row == row) & (cea_sub.column == column)].to_list()[0]
-                    if link:
-                        label = get_wikidata_title(link)
-                        urltable.loc[row, column] = link
-                        labeltable.loc[row, column] = label
-                        bbwtable.loc[row, column] = '<a target="_blank" href="' + link + '">' + label + '</a>'
-
-                except Exception:
-                    pass
-    if not cpa_sub.empty:
-        for column in set(cpa_sub.column.to_list()) or []:
-            try:
-                link = str(cpa_sub.property[cpa_sub.column == column].to_list()[0])
-                label = get_wikidata_title(link)
-                bbwtable.loc['index', column] = '<a target="_blank" href="' + link + '">' + label + '</a>'
-                urltable.loc['index', column] = link
-                labeltable.loc['index', column] = label
-            except Exception:
-                pass
-    if not cta_sub.empty:
-        for column in set(cta_sub.column.to_list()) or []:
-            try:
-                link = str(cta_sub.itemType[cta_sub.column == column].to_list()[0])
-                label = get_wikidata_title(link)
-                bbwtable.loc['type', column] = '<a target="_blank" href="' + link + '">' + label + '</a>'
-                urltable.loc['type', column] = link
-                labeltable.loc['type', column] = label
-            except Exception:
-                pass
+    # The first annotation of each cell, and of each column for CPA and CTA
+    cells = cea_sub.drop_duplicates(['row', 'column'])
+    cells = cells[cells.item.astype(bool)]
+    properties = cpa_sub.drop_duplicates('column').set_index('column').property.astype(str) if not cpa_sub.empty else None
+    types = cta_sub.drop_duplicates('column').set_index('column').itemType.astype(str) if not cta_sub.empty else None
+    links = cells.item.to_list()
+    for annotations in [properties, types]:
+        if annotations is not None:
+            links.extend(annotations.to_list())
+    titles = provider.get_wikidata_titles(links) if links else {}
+    if not cells.empty:
+        urls = cells.pivot(index='row', columns='column', values='item')
+        urls = urls.reindex(index=sorted(urls.index)).astype(object)
+        labels = urls.apply(lambda column: column.map(titles)).astype(object)
+        # The links are built over the annotated columns only, the other columns are added as empty afterwards
+        html = '<a target="_blank" href="' + urls + '">' + labels + '</a>'
+        urltable = urls.reindex(columns=filecsv.columns).astype(object)
+        labeltable = labels.reindex(columns=filecsv.columns).astype(object)
+        urltable.index.name, urltable.columns.name = None, None
+        labeltable.index.name, labeltable.columns.name = None, None
+        html = html.reindex(index=bbwtable.index, columns=bbwtable.columns)
+        bbwtable = bbwtable.mask(html.notna(), html)
+    for name, annotations in [('index', properties), ('type', types)]:
+        if annotations is not None:
+            labels = annotations.map(titles)
+            bbwtable.loc[name] = ('<a target="_blank" href="' + annotations + '">' + labels + '</a>').reindex(bbwtable.columns)
+            urltable.loc[name] = annotations.reindex(urltable.columns)
+            labeltable.loc[name] = labels.reindex(labeltable.columns)
     bbwtable = bbwtable.rename(index={'index': 'property'})
     bbwtable = bbwtable.replace({np.nan: ''})
     bbwtable.columns = bbwtable.iloc[0]
@@ -1265,7 +2878,99 @@ def annotate(filecsv, filename='', language=''):
     labeltable = labeltable.rename(index={'index': 'property'})
     labeltable = labeltable.replace({np.nan: ''})
     labeltable.columns = bbwtable.columns
-    urltable.loc['datatype'] = [get_datatype(prop) for prop in urltable.loc['property',:].to_list()]
+    urltable.loc['datatype'] = [provider.get_datatype(prop) for prop in urltable.loc['property',:].to_list()]
     labeltable.loc['datatype'] = urltable.loc['datatype'].apply(lambda x: x.split('#')[-1] if x else '')
     bbwtable.loc['datatype'] = '<a target="_blank" href="' + urltable.loc['datatype'] + '">' + labeltable.loc['datatype'] + '</a>'
     return [bbwtable, urltable, labeltable, cpa_sub, cea_sub, cta_sub]
+
+
+class AnnotationJobs:
+    """Queue of annotate() jobs which run in a pool of worker threads.
+
+    The jobs are keyed by the hash of the table, the filename and the language.
+    Finished results are kept for the last maxsize tables, so a re-upload of the same table
+    is returned at once. All workers share one provider and thus its caches. The jobs are
+    read and updated under the lock, and status() and result() count as an access of the job.
+    """
+
+    def __init__(self, workers=2, maxsize=64, provider=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.maxsize = maxsize
+        self.provider = provider if provider else CachedProvider()
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(filecsv, filename='', language=''):
+        table = filecsv.to_csv(index=False, header=False)
+        return hashlib.sha1('\t'.join([table, filename, language]).encode('utf-8')).hexdigest()
+
+    def submit(self, filecsv, filename='', language=''):
+        """Queue the table unless it is already queued, running or done. The key of the job is returned."""
+        key = self.key(filecsv, filename, language)
+        with self._lock:
+            job = self.jobs.get(key)
+            if job and job['state'] != 'failed':
+                self.jobs.move_to_end(key)
+                return key
+            self.jobs[key] = {'state': 'queued', 'step': '', 'done': 0, 'total': 0, 'result': None, 'error': ''}
+            self._evict()
+        self.executor.submit(self._run, key, filecsv.copy(), filename, language)
+        return key
+
+    def _evict(self):
+        finished = [k for k, job in self.jobs.items() if job['state'] in ('done', 'failed')]
+        while len(self.jobs) > self.maxsize and finished:
+            del self.jobs[finished.pop(0)]
+
+    def _run(self, key, filecsv, filename, language):
+        with self._lock:
+            job = self.jobs[key]  # queued jobs are not evicted
+            job['state'] = 'running'
+
+        def progress(step, done, total):
+            with self._lock:
+                job.update(step=step, done=done, total=total)
+
+        try:
+            result = annotate(filecsv, filename, language, provider=self.provider, progress=progress)
+            with self._lock:
+                job.update(result=result, state='done')
+        except Exception as e:
+            with self._lock:
+                job.update(error=str(e), state='failed')
+
+    def _get(self, key):
+        # Called with the lock held
+        job = self.jobs.get(key)
+        if job:
+            self.jobs.move_to_end(key)
+        return job
+
+    def status(self, key):
+        """State, current step, processed rows and the result (once done) of the job as a dict,
+        or None for an unknown key, e.g. of a job which was evicted."""
+        with self._lock:
+            job = self._get(key)
+            return dict(job) if job else None
+
+    def result(self, key):
+        """The output of annotate() for a finished job, otherwise None."""
+        with self._lock:
+            job = self._get(key)
+            return job['result'] if job else None
+
+
+annotation_jobs = None
+annotation_jobs_lock = threading.Lock()
+
+
+def get_annotation_jobs(workers=2, maxsize=64, cachesize=20000):
+    """The job queue shared by all sessions of this process. It is created on the first call.
+    Its provider keeps the last cachesize lookups and other query results each."""
+    global annotation_jobs
+    with annotation_jobs_lock:
+        if annotation_jobs is None:
+            provider = CachedProvider(maxresults=cachesize, cachesize=cachesize)
+            annotation_jobs = AnnotationJobs(workers=workers, maxsize=maxsize, provider=provider)
+    return annotation_jobs
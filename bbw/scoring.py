@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+
+# Keys and annotation column of the CEA, CPA and CTA dataframes returned by postprocessing()
+keys = {'cea': ['file', 'row', 'column'], 'cpa': ['file', 'column0', 'column'], 'cta': ['file', 'column']}
+annotations = {'cea': 'item', 'cpa': 'property', 'cta': 'itemType'}
+
+
+def typed_keys(df, task):
+    """Cast the keys to str (file) and int (row, column0, column)."""
+    return df.astype({k: (str if k == 'file' else int) for k in keys[task]})
+
+
+def normalize(annotation):
+    """Keep only the QID or PID of the URLs in a series. Each distinct URL is shortened once."""
+    codes, urls = pd.factorize(annotation.fillna('').astype(str))
+    short = np.array([url.strip().rsplit('/', 1)[-1] for url in urls] + [''], dtype=object)
+    return pd.Series(short[codes], index=annotation.index, dtype=object)
+
+
+def read_annotations(path, task):
+    """Read a submission or a ground-truth CSV-file in SemTab-format without header."""
+    return pd.read_csv(path, dtype=str, header=None, names=keys[task] + [annotations[task]])
+
+
+def get_how_matched(annotation_list, task):
+    """The step (how_matched) of each annotation from the unprocessed cea_list or cpa_list.
+    If an annotation is found in several steps, the first one is taken.
+    Returns a dataframe with the keys, the annotation (QID or PID) and how_matched."""
+    if task == 'cea':
+        df = pd.DataFrame(annotation_list, columns=['file', 'row', 'column', 'item', 'itemType', 'how_matched',
+                                                    'what_matched'])
+        df = df[['file', 'row', 'column', 'item', 'how_matched']].explode('item')
+    elif task == 'cpa':
+        df = pd.DataFrame(annotation_list, columns=['file', 'row', 'column0', 'column', 'property', 'item', 'itemType',
+                                                    'how_matched', 'what_matched'])
+        df = df[['file', 'column0', 'column', 'property', 'how_matched']].explode('property')
+        df['property'] = df.property.map(lambda x: x[0] if isinstance(x, tuple) else x)
+    else:
+        raise ValueError('how_matched is only recorded for CEA and CPA.')
+    df = df.dropna(subset=[annotations[task]])
+    df[annotations[task]] = normalize(df[annotations[task]])
+    return typed_keys(df, task).drop_duplicates(keys[task] + [annotations[task]])
+
+
+def score(submission, ground_truth, task, annotation_list=None):
+    """
+    Parameters
+    ----------
+    submission : pd.DataFrame
+        CEA, CPA or CTA dataframe from postprocessing() or read_annotations().
+    ground_truth : pd.DataFrame
+        The ground truth with the same columns. Several correct annotations are separated by spaces.
+    task : str
+        'cea', 'cpa' or 'cta'.
+    annotation_list : list, optional
+        The unprocessed cea_list (CEA) or cpa_list (CPA) for a breakdown by how_matched.
+    Returns
+    -------
+    list
+        [
+        scores - dict with precision, recall, f1 and the numbers of correct, submitted and target annotations,
+        breakdown - dataframe with the correct and submitted annotations and the precision per how_matched,
+                    or None without annotation_list
+        ].
+    """
+    key = keys[task]
+    column = annotations[task]
+    truth = typed_keys(ground_truth[key + [column]], task).drop_duplicates(key)
+    ntargets = len(truth)
+    # Only the targets in the ground truth are scored, they are joined by their position in the ground truth
+    targets = pd.MultiIndex.from_frame(truth[key])
+    sub = typed_keys(submission[key + [column]], task).drop_duplicates(key)
+    position = targets.get_indexer(pd.MultiIndex.from_frame(sub[key]))
+    joined = sub[position >= 0][key].assign(target=position[position >= 0],
+                                           annotation=normalize(sub[column][position >= 0]))
+    # One pair (target, annotation) per correct annotation, several are separated by spaces
+    answers = truth[column].fillna('').astype(str)
+    multiple = answers.str.contains(' ', regex=False).values
+    pairs = pd.DataFrame({'target': range(ntargets), 'annotation': answers.values})
+    if multiple.any():
+        pairs = pd.concat([pairs[~multiple], pairs[multiple].assign(annotation=pairs.annotation[multiple].str.split())
+                          .explode('annotation')], ignore_index=True)
+    pairs = pd.MultiIndex.from_arrays([pairs.target.values, normalize(pairs.annotation).values])
+    joined['is_correct'] = pairs.get_indexer(pd.MultiIndex.from_arrays([joined.target.values,
+                                                                         joined.annotation.values])) >= 0
+    joined = joined.drop(columns=['target'])
+    ncorrect, nsubmitted = int(joined.is_correct.sum()), len(joined)
+    precision = ncorrect / nsubmitted if nsubmitted else 0.0
+    recall = ncorrect / ntargets if ntargets else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    scores = {'task': task.upper(), 'precision': precision, 'recall': recall, 'f1': f1,
+              'correct': ncorrect, 'submitted': nsubmitted, 'targets': ntargets}
+    breakdown = None
+    if annotation_list is not None:
+        how = get_how_matched(annotation_list, task).rename(columns={column: 'annotation'})
+        joined = joined.merge(how, on=key + ['annotation'], how='left')
+        joined['how_matched'] = joined.how_matched.fillna('unknown')
+        breakdown = joined.groupby('how_matched').agg(correct=('is_correct', 'sum'),
+                                                      submitted=('is_correct', 'size')).reset_index()
+        breakdown['precision'] = breakdown.correct / breakdown.submitted
+        breakdown['share_of_targets'] = breakdown.submitted / ntargets if ntargets else 0.0
+        breakdown = breakdown.sort_values('submitted', ascending=False, kind='stable').reset_index(drop=True)
+    return [scores, breakdown]
+
+
+def evaluate(cpa_sub, cea_sub, cta_sub, gt_cpa, gt_cea, gt_cta, cpa_list=None, cea_list=None, filelist=None):
+    """Score the outputs of postprocessing() against the ground truth of all three tasks.
+    With a filelist, only the ground truth of these files is used, e.g. for a slice of a round.
+    Returns [scores, breakdowns]: a dataframe with one row per task and a dictionary with
+    the breakdowns by how_matched for CEA and CPA."""
+    rows = []
+    breakdowns = {}
+    for task, submission, truth, annotation_list in [('cea', cea_sub, gt_cea, cea_list),
+                                                      ('cpa', cpa_sub, gt_cpa, cpa_list),
+                                                      ('cta', cta_sub, gt_cta, None)]:
+        if not isinstance(truth, pd.DataFrame):
+            continue
+        if filelist is not None:
+            truth = truth[truth.file.isin(filelist)]
+        [scores, breakdown] = score(submission, truth, task, annotation_list)
+        rows.append(scores)
+        if breakdown is not None:
+            breakdowns[task] = breakdown
+    return [pd.DataFrame(rows), breakdowns]
@@ -1,20 +1,49 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from bbw.bbw import preprocessing, contextual_matching, postprocessing
+from bbw.scoring import evaluate, read_annotations
+from bbw.bbw import contextual_matching, postprocessing, timeout_controller, Budget, \
+    DeferredSteps, LookupCache, preload_language_model, get_table_language, create_targets_db, get_targets, \
+    load_tables, ResultStore, contextual_matching_chunked, read_table_windows, WikidataProvider, url_query
 import pandas as pd
 import csv
 import argparse
 from tqdm import tqdm
 import time
 import os
+from itertools import chain
 import sys
 
 # Specify CLI
 parser = argparse.ArgumentParser()
 parser.add_argument('--amount', nargs='?', type=int, help='The amount of files that are considered. By default the script goes over all files but it is possible to only consider a certain amount of them.')
 parser.add_argument('--offset', nargs='?', type=int, help='The offset will make it possible to ignore the first files and start with some offset. By default no offset is set.')
+parser.add_argument('--table-budget', nargs='?', type=float, help='The time budget in seconds for all SPARQL queries of a table. By default there is no budget and the queries use adaptive timeouts only.')
+parser.add_argument('--hedge', action='store_true', help='Send a duplicate SPARQL query if the first one is slower than 90 percent of the previous queries of its kind.')
+parser.add_argument('--time-budget', nargs='?', type=float, help='The time budget in seconds per table. Once it is exhausted, the optional steps 3-6 are skipped for the remaining rows of the table.')
+parser.add_argument('--request-budget', nargs='?', type=int, help='The budget of SPARQL queries per table for the optional steps 3-6.')
+parser.add_argument('--run-time-budget', nargs='?', type=float, help='The time budget in seconds for all tables. Once it is exhausted, the optional steps 3-6 are skipped for the remaining tables.')
+parser.add_argument('--run-request-budget', nargs='?', type=int, help='The budget of SPARQL queries for all tables.')
+parser.add_argument('--filelist', nargs='?', help='CSV-file with filenames in the first column, e.g. skipped.csv of a previous run with a budget. Only these files are annotated.')
+parser.add_argument('--deferred', action='store_true', help='Run steps 5 and 6 after all tables are processed by the other steps. The unmatched cells of all tables are grouped by column type and language and resolved with batched queries.')
+parser.add_argument('--lookup-cache', nargs='?', help='Folder for the lookup results of the main-column values. It is shared by parallel runs and later runs.')
+parser.add_argument('--prefetch', nargs='?', type=int, help='The number of threads which look up all distinct main-column values of the files before the annotation. Each value is looked up only once.')
+parser.add_argument('--prefetch-only', action='store_true', help='Only look up the main-column values into --lookup-cache and exit, e.g. before several parallel runs.')
+parser.add_argument('--language-mode', nargs='?', choices=['cell', 'majority'], default='cell', help='Detect the language of each cell (default) or use the majority language of the main column for the whole table.')
+parser.add_argument('--targets-db', nargs='?', help='SQLite database with the targets indexed by file. It is created from the target CSV-files if it does not exist. Each run reads only the targets of its files.')
+parser.add_argument('--readers', nargs='?', type=int, default=4, help='The number of threads which read and preprocess the tables ahead of the annotation.')
+parser.add_argument('--row-workers', nargs='?', type=int, default=1, help='The number of threads which look up the rows of a table in step 2. The output is the same as with one thread.')
+parser.add_argument('--chunksize', nargs='?', type=int, help='Annotate the tables in windows of this many rows. Only the annotations, column statistics and unmatched rows are kept in memory, so very large tables fit. The table cache is not used.')
+parser.add_argument('--table-cache', nargs='?', help='Folder for the preprocessed tables. Later runs read them from there instead of parsing and fixing the CSV-files again.')
+parser.add_argument('--incremental', nargs='?', help='Folder for the results per table. Only new or modified tables are annotated, the results of the unchanged tables are taken from there.')
+parser.add_argument('--endpoint', nargs='?', default=url_query, help='The SPARQL-endpoint, e.g. a local utils/sparql_server.py. The default is https://query.wikidata.org/sparql.')
+parser.add_argument('--projection', action='store_true', help='Look up the items of the main-column values first and then only their claims which are equal to a value of the row. All claims are looked up only for values without such a claim. The output is the same.')
+parser.add_argument('--sample', nargs='?', type=int, help='Look up only this many rows of each table without constraints. The type of the main column and the properties found in them constrain the batched lookups of the other rows, if the sample passes the accuracy check.')
+parser.add_argument('--min-accuracy', nargs='?', type=float, default=0.9, help='The share of the sample rows which must get the same main-column item with the constrained lookups. The default is 0.9.')
+parser.add_argument('--ground-truth', nargs='?', help='Folder with the ground truth CEA_Round<n>_gt.csv, CPA_Round<n>_gt.csv and CTA_Round<n>_gt.csv. The annotations of the files in this run are scored.')
 args = parser.parse_args()
+timeout_controller.table_budget = args.table_budget
+timeout_controller.hedge = args.hedge
 
 # Path to the folders with target tables and input tables
 path = ''
@@ -24,38 +53,140 @@ nround = str(2)
 nsubmission = str(42)
 
 try:
-    # Load the target data
-    target_cpa = pd.read_csv(path+f"target/CPA_Round{nround}_Targets.csv", names=['file', 'column0', 'column'], dtype=object)
-    target_cta = pd.read_csv(path+f"target/CTA_Round{nround}_Targets.csv", names=['file', 'column'], dtype=object)
-    target_cea = pd.read_csv(path+f"target/CEA_Round{nround}_Targets.csv", names=['file', 'row', 'column'], dtype=object)
-
-    # Create a list of filenames for matching in CPA, CEA and CTA tasks
-    filelist = target_cpa.file.to_list() + target_cea.file.to_list() + target_cta.file.to_list()
-    filelist = sorted(list(set(filelist)))
-    if args.amount is None:
-        args.amount = len(filelist)
+    only = None
+    if args.filelist:
+        only = set(pd.read_csv(args.filelist, usecols=[0], dtype=str).iloc[:, 0].to_list())
     if args.offset is None:
         args.offset = 0
-    filelist = filelist[args.offset:args.offset + args.amount]
+    if args.targets_db:
+        # Load only the targets of this slice of files from the indexed targets
+        if not os.path.exists(args.targets_db):
+            tmp = args.targets_db + '.' + str(os.getpid())  # parallel runs may create it at the same time
+            create_targets_db(tmp, path+f"target/CPA_Round{nround}_Targets.csv",
+                              path+f"target/CEA_Round{nround}_Targets.csv", path+f"target/CTA_Round{nround}_Targets.csv")
+            os.replace(tmp, args.targets_db)
+        [filelist, target_cpa, target_cea, target_cta] = get_targets(args.targets_db, args.offset, args.amount, only)
+    else:
+        # Load the target data
+        target_cpa = pd.read_csv(path+f"target/CPA_Round{nround}_Targets.csv", names=['file', 'column0', 'column'], dtype=object)
+        target_cta = pd.read_csv(path+f"target/CTA_Round{nround}_Targets.csv", names=['file', 'column'], dtype=object)
+        target_cea = pd.read_csv(path+f"target/CEA_Round{nround}_Targets.csv", names=['file', 'row', 'column'], dtype=object)
+
+        # Create a list of filenames for matching in CPA, CEA and CTA tasks
+        filelist = target_cpa.file.to_list() + target_cea.file.to_list() + target_cta.file.to_list()
+        filelist = sorted(list(set(filelist)))
+        if only is not None:
+            filelist = [filename for filename in filelist if filename in only]
+        if args.amount is None:
+            args.amount = len(filelist)
+        filelist = filelist[args.offset:args.offset + args.amount]
 
     if __name__ == "__main__":
         print(args)
+        preload_language_model()
         cpa, cea, nomatch = [], [], []
+        budget = None
+        if args.time_budget or args.request_budget or args.run_time_budget or args.run_request_budget:
+            budget = Budget(args.time_budget, args.request_budget, args.run_time_budget, args.run_request_budget)
+        if args.lookup_cache or args.prefetch or args.prefetch_only:
+            provider = LookupCache(args.lookup_cache, url=args.endpoint, projection=args.projection)
+        else:
+            provider = WikidataProvider(url=args.endpoint, projection=args.projection)
+        deferred = DeferredSteps(provider=provider) if args.deferred else None
+        steps = {'step3': False, 'step4': False, 'step5': True, 'step6': True}
+        tablepaths = [path+f'tables_round{nround}/'+filename+'.csv' for filename in filelist]
+        # Reuse the results of the unchanged tables
+        store, changed, changedpaths = None, filelist, tablepaths
+        if args.incremental:
+            # Every option which affects the results is part of the configuration
+            config = dict(steps, language_mode=args.language_mode, endpoint=args.endpoint, projection=args.projection,
+                          sample=args.sample, min_accuracy=args.min_accuracy, deferred=args.deferred,
+                          chunksize=args.chunksize)
+            store = ResultStore(args.incremental, config)
+            changed, changedpaths = [], []
+            for filename, tablepath in zip(filelist, tablepaths):
+                previous = store.get(filename, tablepath)
+                if previous:
+                    cpa.extend(previous[0])
+                    cea.extend(previous[1])
+                    nomatch.extend(previous[2])
+                else:
+                    changed.append(filename)
+                    changedpaths.append(tablepath)
+            print(len(changed), 'of', len(filelist), 'tables are new or modified.')
+        # Look up the distinct values of the main columns of all files at once
+        if args.prefetch or args.prefetch_only:
+            names = {}
+            for filecsv in tqdm(load_tables(changedpaths, args.readers, args.table_cache), total=len(changed)):
+                language = get_table_language(filecsv) if args.language_mode == 'majority' else ''
+                names.setdefault(language, set()).update(filecsv.iloc[1:, 0].to_list())
+            for language in names:
+                nresolved = provider.prefetch(names[language], language, workers=args.prefetch or 8)
+                print(nresolved, 'of', len(names[language]), 'distinct values are looked up.')
+            if args.prefetch_only:
+                sys.exit(0)
         # Annotate files from filelist
-        for ind, filename in enumerate(tqdm(filelist)):
-            filecsv = pd.read_csv(path+f'tables_round{nround}/'+filename+'.csv', dtype=str, header=None)
-            filecsv = preprocessing(filecsv)
-            [cpa, cea, nomatch] = contextual_matching(filecsv, filename, cpa, cea, nomatch, 
-                                                      step3=False, step4=False, step5=True, step6=True)
+        if args.chunksize:
+            tables = (read_table_windows(tablepath, args.chunksize) for tablepath in changedpaths)
+            matching = contextual_matching_chunked
+        else:
+            tables = load_tables(changedpaths, args.readers, args.table_cache)
+            matching = contextual_matching
+        for ind, (filename, filecsv) in enumerate(tqdm(zip(changed, tables), total=len(changed))):
+            language = ''
+            if args.language_mode == 'majority':
+                if args.chunksize:  # The language is detected in the first window
+                    first = next(filecsv)
+                    filecsv = chain([first], filecsv)
+                    language = get_table_language(first)
+                else:
+                    language = get_table_language(filecsv)
+            [cpa, cea, nomatch] = matching(filecsv, filename, language, default_cpa=cpa, default_cea=cea,
+                                           default_nomatch=nomatch, **steps,
+                                           budget=budget, deferred=deferred,
+                                           provider=provider, workers=args.row_workers,
+                                           sample=args.sample, min_accuracy=args.min_accuracy)
+        # Resolve steps 5 and 6 for all tables at once
+        if deferred:
+            [cpa, cea] = deferred.resolve(cpa, cea)
+        # Store the results of the annotated tables, except for tables with rows skipped due to the budget
+        if store:
+            skipped = set([k[0] for k in budget.skipped]) if budget else set()
+            results = {filename: [[], [], []] for filename in changed if filename not in skipped}
+            for i, entries in enumerate([cpa, cea, nomatch]):
+                for k in entries:
+                    if k[0] in results:
+                        results[k[0]][i].append(k)
+            for filename, tablepath in zip(changed, changedpaths):
+                if filename in results:
+                    store.put(filename, tablepath, *results[filename])
         # Postprocess cpa and cea lists and return the ready-for-submission dataframes
         [cpa_sub, cea_sub, cta_sub] = postprocessing(cpa, cea, filelist, 
-                                                     target_cpa, target_cea, target_cta)
+                                                     target_cpa, target_cea, target_cta, provider=provider)
         # Save CP-, CE- and CT-Annotations to csv-files
         now = time.time() # It separates the outputs of parallel runs in different folders
         os.mkdir(f'r{nround}_s{nsubmission}_'+str(now))
         cpa_sub.to_csv(f'r{nround}_s{nsubmission}_{now}/bbw_r{nround}_s{nsubmission}_cpa_sub.csv', index=False, header=False, quoting=csv.QUOTE_ALL)
         cea_sub.to_csv(f'r{nround}_s{nsubmission}_{now}/bbw_r{nround}_s{nsubmission}_cea_sub.csv', index=False, header=False, quoting=csv.QUOTE_ALL)
         cta_sub.to_csv(f'r{nround}_s{nsubmission}_{now}/bbw_r{nround}_s{nsubmission}_cta_sub.csv', index=False, header=False, quoting=csv.QUOTE_ALL)
+        # Score the annotations of this run
+        if args.ground_truth:
+            gt = {}
+            for task in ['cea', 'cpa', 'cta']:
+                gtfile = os.path.join(args.ground_truth, f'{task.upper()}_Round{nround}_gt.csv')
+                gt[task] = read_annotations(gtfile, task) if os.path.exists(gtfile) else None
+            [scores, breakdowns] = evaluate(cpa_sub, cea_sub, cta_sub, gt['cpa'], gt['cea'], gt['cta'],
+                                            cpa_list=cpa, cea_list=cea, filelist=filelist)
+            print('\n*** Scores ***')
+            print(scores.to_string(index=False))
+            for task, breakdown in breakdowns.items():
+                print(f'\n{task.upper()} by how_matched')
+                print(breakdown.to_string(index=False))
+            scores.to_csv(f'r{nround}_s{nsubmission}_{now}/scores.csv', index=False)
+        # Save the rows skipped due to the budget. Use them with --filelist in a later run.
+        if budget and budget.skipped:
+            skipped = pd.DataFrame(budget.skipped, columns=['file', 'row', 'step']).drop_duplicates()
+            skipped.to_csv(f'r{nround}_s{nsubmission}_{now}/skipped.csv', index=False, quoting=csv.QUOTE_ALL)
 
 except FileNotFoundError as e:
     print(e)
@@ -1,7 +1,8 @@
 import pandas as pd
 import streamlit as st
-from bbw.bbw import annotate
+from bbw.bbw import annotate, get_annotation_jobs
 import base64
+import time
 from io import StringIO
 
 st.set_page_config(page_title="bbw", page_icon=None, layout='centered', initial_sidebar_state='auto')
@@ -10,6 +11,8 @@ st.set_page_config(page_title="bbw", page_icon=None, layout='centered', initial_
 def settings():
     st.set_option('client.caching', False)
     st.sidebar.title("bbw: Match CSV to Wikidata")
+    return st.sidebar.checkbox("Annotate in the background", value=True,
+                               help="Queue the table to a worker pool and show the progress. Annotated tables are cached.")
 
 
 def get_table_download_link(df, fname):
@@ -36,10 +39,37 @@ def process_data(uploaded_file):
     return [csvfile, filename, rawtable]
 
 
-def annotate_data(csvfile, filename):
+def wait_for_job(csvfile, filename):
+    jobs = get_annotation_jobs()
+    key = jobs.submit(csvfile, filename)
+    status = jobs.status(key)
+    if status is None or status['state'] != 'done':
+        info = st.empty()
+        bar = st.progress(0)
+        while status is None or status['state'] in ('queued', 'running'):
+            if status is None:  # The job was evicted meanwhile, e.g. by the results of many other tables
+                key = jobs.submit(csvfile, filename)
+            elif status['state'] == 'queued':
+                info.text('Waiting for a free worker...')
+            else:
+                info.text(f"{status['step']}: {status['done']} of {status['total']} rows")
+                bar.progress(min(status['done'] / status['total'], 1.0) if status['total'] else 0)
+            time.sleep(0.5)
+            status = jobs.status(key)
+        info.empty()
+        bar.empty()
+    if status['state'] == 'failed':
+        raise RuntimeError(status['error'])
+    return status['result']
+
+
+def annotate_data(csvfile, filename, background=True):
     bbwtable = st.empty()
     with bbwtable.beta_container():
-        [webtable, urltable, labeltable, cpa_sub, cea_sub, cta_sub] = annotate(csvfile,filename)
+        if background:
+            [webtable, urltable, labeltable, cpa_sub, cea_sub, cta_sub] = wait_for_job(csvfile, filename)
+        else:
+            [webtable, urltable, labeltable, cpa_sub, cea_sub, cta_sub] = annotate(csvfile,filename)
         st.subheader("OUTPUT: Semantically annotated web table")
         st.write(webtable.to_html(render_links=True, escape=False), unsafe_allow_html=True)
         st.markdown(get_table_download_link(webtable, filename), unsafe_allow_html=True)
@@ -62,7 +92,7 @@ def annotate_data(csvfile, filename):
 
 
 if __name__ == "__main__":
-    settings()
+    background = settings()
     filebox = st.empty()
     with filebox.beta_container():
         uploaded_file = st.sidebar.file_uploader("Choose a raw CSV-file", type=['csv'])
@@ -72,6 +102,6 @@ if __name__ == "__main__":
             except Exception:
                 st.info('Something went wrong: bbw is unable to process the input '+filename)
             try:
-                bbwtable = annotate_data(csvfile, filename)
+                bbwtable = annotate_data(csvfile, filename, background)
             except Exception:
                 st.info('Something went wrong: bbw is unable to annotate the input '+filename)        
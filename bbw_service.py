@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from bbw.bbw import annotate, CachedProvider, preload_language_model, timeout_controller, url_query
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+import pandas as pd
+import argparse
+import json
+import threading
+import time
+
+# Specify CLI
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', nargs='?', default='127.0.0.1', help='The host of the service. By default it is only reachable from localhost.')
+parser.add_argument('--port', nargs='?', type=int, default=8502, help='The port of the service. The default is 8502.')
+parser.add_argument('--workers', nargs='?', type=int, default=4, help='The number of tables annotated at the same time. Further requests wait.')
+parser.add_argument('--lookup-cache', nargs='?', help='Folder for the lookup results. By default they are kept in memory.')
+parser.add_argument('--endpoint', nargs='?', default=url_query, help='The SPARQL-endpoint, e.g. a local utils/sparql_server.py.')
+parser.add_argument('--class-indexes', nargs='?', type=int, default=32, help='The number of class-label indexes (step 6) kept in memory.')
+parser.add_argument('--cache-size', nargs='?', type=int, default=100000, help='The number of lookups and of other query results kept in memory each. The default is 100000.')
+
+
+class Metrics:
+    """Health and throughput metrics of the service."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.tables = 0
+        self.rows = 0
+        self.errors = 0
+        self.running = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def as_dict(self, provider):
+        uptime = time.time() - self.start
+        with self.lock:
+            return {'uptime': round(uptime, 1),
+                    'tables': self.tables,
+                    'rows': self.rows,
+                    'errors': self.errors,
+                    'running': self.running,
+                    'tables_per_minute': round(60 * self.tables / uptime, 3) if uptime else 0,
+                    'rows_per_second': round(self.rows / uptime, 3) if uptime else 0,
+                    'mean_seconds_per_table': round(self.seconds / self.tables, 3) if self.tables else None,
+                    'sparql_requests': timeout_controller.requests,
+                    'lookup_hits': provider.hits,
+                    'lookup_misses': provider.misses,
+                    # With --lookup-cache, the lookups are stored in the folder instead
+                    'cached_lookups': None if provider.directory else len(provider.results),
+                    'cached_class_indexes': len(provider.class_labels),
+                    'cached_queries': len(provider.cache)}
+
+
+def read_table(body, content_type):
+    """Read a table from a request body: CSV or JSON {"table": [[...], ...], "filename": "", "language": ""}."""
+    if 'json' in content_type:
+        data = json.loads(body)
+        table = pd.DataFrame(data.get('table')).fillna('').astype(str)
+        return [table, data.get('filename', ''), data.get('language', '')]
+    return [pd.read_csv(StringIO(body), dtype=str, header=None), '', '']
+
+
+def make_handler(provider, metrics, slots):
+    """Create the request handler using the shared warm provider."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok', 'uptime': round(time.time() - metrics.start, 1)})
+            elif self.path == '/metrics':
+                self.send_json(200, metrics.as_dict(provider))
+            else:
+                self.send_json(404, {'error': 'Use GET /health, GET /metrics or POST /annotate.'})
+
+        def do_POST(self):
+            if self.path != '/annotate':
+                self.send_json(404, {'error': 'Use GET /health, GET /metrics or POST /annotate.'})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                [table, filename, language] = read_table(body, self.headers.get('Content-Type', ''))
+            except Exception as e:
+                self.send_json(400, {'error': 'bbw is unable to read the table: ' + str(e)})
+                return
+            with slots:
+                with metrics.lock:
+                    metrics.running += 1
+                start = time.time()
+                try:
+                    output = annotate(table, filename, language, provider=provider)
+                except Exception as e:
+                    output = e
+                seconds = time.time() - start
+                with metrics.lock:
+                    metrics.running -= 1
+                    if isinstance(output, Exception):
+                        metrics.errors += 1
+                    else:
+                        metrics.tables += 1
+                        metrics.rows += len(table)
+                        metrics.seconds += seconds
+            if isinstance(output, Exception):
+                self.send_json(500, {'error': 'bbw is unable to annotate the table: ' + str(output)})
+                return
+            names = ['web_table', 'url_table', 'label_table', 'cpa', 'cea', 'cta']
+            result = {name: json.loads(df.to_json(orient='split')) for name, df in zip(names, output)}
+            result['seconds'] = round(seconds, 3)
+            self.send_json(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    preload_language_model()
+    provider = CachedProvider(maxsize=args.class_indexes, maxresults=args.cache_size, cachesize=args.cache_size,
+                              directory=args.lookup_cache, url=args.endpoint)
+    metrics = Metrics()
+    slots = threading.BoundedSemaphore(args.workers)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(provider, metrics, slots))
+    print(f'bbw annotation service at http://{args.host}:{args.port}/annotate')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
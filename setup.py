@@ -25,7 +25,7 @@ setup(
 	"beautifulsoup4>=4.9.3",
     "langid>=1.1.6",
     ],
-    scripts=['bbw_cli.py','bbw_gui.py','bbw_parallel.sh'],
+    scripts=['bbw_cli.py','bbw_gui.py','bbw_service.py','bbw_parallel.sh'],
     packages=find_packages(),
     classifiers=[
 	"License :: OSI Approved :: MIT License",
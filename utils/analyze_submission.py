@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import csv
+import argparse
+from functools import lru_cache
+from tqdm import tqdm
+from merge_submission import tasks
+
+parser = argparse.ArgumentParser(description='Analyze a CPA, CEA or CTA submission: which targets are missing and '
+                                             'which values of the tables are annotated with which property, item or type.')
+parser.add_argument('task', choices=sorted(tasks), help='The task of the submission.')
+parser.add_argument('target', help='The target CSV-file.')
+parser.add_argument('submission', help='The submission CSV-file.')
+parser.add_argument('--tables', nargs='?', default='../tables/', help='The folder with the tables. The default is ../tables/.')
+parser.add_argument('--only', nargs='*', help='Analyse only these properties, items or types, e.g. P2044. By default all of them.')
+parser.add_argument('--cache-size', nargs='?', type=int, default=256, help='The number of tables kept in memory. The default is 256.')
+parser.add_argument('--output', nargs='?', default='', help='Prefix of the output files <task>_analysis.csv and <task>_missings.csv.')
+
+# Prefixes which are removed from the annotations, only the PID or QID is kept
+prefixes = r'^http://www\.wikidata\.org/(prop/(direct/|direct-normalized/|reference/value-normalized/|reference/value/|reference/|statement/)?|entity/)'
+headers = {'cpa': ['property', 'value', 'subject', 'tableid', 'columnid'],
+           'cea': ['item', 'value', 'subject', 'tableid', 'rowid', 'columnid'],
+           'cta': ['type', 'value', 'subject', 'tableid', 'columnid']}
+
+
+def sort_key(annotation):
+    """Sort the annotations by the number after the P or Q."""
+    number = annotation[1:]
+    return (0, int(number), annotation) if number.isdigit() else (1, 0, annotation)
+
+
+def make_table_loader(folder, maxsize):
+    """Read the tables with pd.read_csv(dtype=str, header=None), keeping the last maxsize tables in memory."""
+
+    @lru_cache(maxsize=maxsize)
+    def load_table(tableid):
+        try:
+            return pd.read_csv(folder + tableid + '.csv', dtype=str, header=None)
+        except Exception:
+            print("ERROR: unable to read the table", tableid)
+            return None
+
+    return load_table
+
+
+def expand(requests, task, load_table):
+    """Expand the requests [label, tableID, (row,) column, order] to the values of the tables.
+    The requests are grouped by table, so each table is read once. CPA and CTA requests
+    expand to all rows of the column, CEA requests to their cell."""
+    rows = []
+    column = tasks[task]['key'][-1]
+    for tableid, group in tqdm(requests.groupby('tableID', sort=False), total=requests.tableID.nunique()):
+        filecsv = load_table(tableid)
+        if filecsv is None:
+            continue
+        (nrows, ncols) = filecsv.shape
+        group = group.assign(columnid=group[column].astype(int))
+        out_of_range = group.columnid >= ncols
+        for colx in group.columnid[out_of_range].unique():
+            print("ERROR: columnid out of range", tableid, colx)
+        group = group[~out_of_range]
+        if task == 'cea':
+            group = group.assign(rowid=group.row.astype(int))
+            group = group[group.rowid < nrows]
+            rows.append(pd.DataFrame({'label': group.label.values,
+                                      'value': filecsv.values[group.rowid.values, group.columnid.values],
+                                      'subject': filecsv.values[group.rowid.values, 0],
+                                      'tableid': tableid, 'rowid': group.rowid.values,
+                                      'columnid': group.columnid.values, 'order': group.order.values}))
+        else:
+            subject = filecsv.iloc[1:, 0].values
+            for [label, colx, order] in group[['label', 'columnid', 'order']].values:
+                rows.append(pd.DataFrame({'label': label, 'value': filecsv.iloc[1:, colx].values, 'subject': subject,
+                                          'tableid': tableid, 'columnid': colx, 'order': order}))
+    if not rows:
+        columns = ['label', 'value', 'subject', 'tableid', 'rowid', 'columnid'] if task == 'cea' else \
+            ['label', 'value', 'subject', 'tableid', 'columnid']
+        return pd.DataFrame(columns=columns)
+    return pd.concat(rows, ignore_index=True).sort_values('order', kind='stable').drop(columns=['order'])
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    key = tasks[args.task]['key']
+    value = tasks[args.task]['submission'][-1]
+    target = pd.read_csv(args.target, dtype=object, names=tasks[args.task]['target'])
+    submitted = pd.read_csv(args.submission, dtype=object, names=tasks[args.task]['submission'])
+    load_table = make_table_loader(args.tables, args.cache_size)
+
+    # Join the targets with the submission once
+    joined = target.merge(submitted[key].drop_duplicates().assign(submitted=True), on=key, how='left')
+    missing = joined[joined.submitted.isna()].drop(columns=['submitted'])
+
+    # Some simple statistics
+    print('\n# Table statistics')
+    total_matched = len(submitted)
+    total_targets = len(target)
+    print(total_matched, "of the total", total_targets, "targets are matched.")
+    print("Thus we still have", total_targets - total_matched, "targets in the tables which are not matched at all!\n")
+    print("==> (Internal) Recall =", total_matched / total_targets if total_targets else 0)
+    duplicated = submitted[submitted.duplicated(key, keep=False)].drop_duplicates(key)
+    for k in duplicated[key].values:
+        print("ERROR: There are several submitted values for the same key", *k)
+    if args.task == 'cpa':
+        for k in submitted[submitted.colx == '0'][key].values:
+            print("ERROR: 0 is not expected here", *k)
+
+    # case 1: the complete table is missing in the submission
+    submitted_tables = set(submitted.tableID)
+    missing_tables = [t for t in missing.tableID.drop_duplicates() if t not in submitted_tables]
+    complete_missings = []
+    for tableid in tqdm(missing_tables):
+        filecsv = load_table(tableid)
+        if filecsv is not None:
+            complete_missings.append(pd.DataFrame({'value col0': filecsv.iloc[1:, 0].values, 'tableid': tableid}))
+    print(len(missing_tables), "tables are missing in the submission.")
+
+    # case 2: only some targets of this table are missing in the submission
+    requests = [missing[missing.tableID.isin(submitted_tables)].assign(label='missing')]
+    # The annotations in the submission, sorted by the number of the PID or QID
+    submitted['label'] = submitted[value].fillna('').str.replace(prefixes, '', regex=True)
+    labels = sorted(set(submitted.label), key=sort_key)
+    if args.only:
+        labels = [label for label in labels if label in args.only]
+    order = {label: i for i, label in enumerate(labels)}
+    found = submitted[submitted.label.isin(order)]
+    for label, count in found.label.value_counts().reindex(labels).items():
+        print("# Found", count, "instances for", label)
+    requests.append(found.assign(rank=found.label.map(order)).sort_values('rank', kind='stable').drop(columns=['rank']))
+    requests = pd.concat(requests, ignore_index=True)
+    requests['order'] = range(len(requests))
+    analysis = expand(requests, args.task, load_table)
+
+    # Save to csv-files
+    analysis[[c for c in ['label', 'value', 'subject', 'tableid', 'rowid', 'columnid'] if c in analysis.columns]] \
+        .to_csv(args.output + args.task + '_analysis.csv', index=False, quoting=csv.QUOTE_ALL, header=headers[args.task])
+    if len(complete_missings) > 0:
+        pd.concat(complete_missings, ignore_index=True) \
+            .to_csv(args.output + args.task + '_missings.csv', index=False, quoting=csv.QUOTE_ALL)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Startup time of the processes spawned by bbw_parallel.sh
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', nargs='?', type=int, default=10, help='The number of measurements per command.')
+parser.add_argument('--importtime', action='store_true', help='Show the slowest imports of bbw.bbw (python -X importtime).')
+args = parser.parse_args()
+
+commands = {
+    'import bbw.bbw': [sys.executable, '-c', 'import bbw.bbw'],
+    'bbw_cli.py --help': [sys.executable, 'bbw_cli.py', '--help'],
+    'preload_language_model()': [sys.executable, '-c',
+                                 'from bbw.bbw import preload_language_model; preload_language_model()'],
+}
+
+print('Command', 'Min', 'Median', 'Max', sep='\t')
+for name, command in commands.items():
+    times = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    print(name, round(min(times), 3), round(statistics.median(times), 3), round(max(times), 3), sep='\t')
+
+if args.importtime:
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bbw.bbw'],
+                            stderr=subprocess.PIPE, universal_newlines=True).stderr
+    imports = []
+    for line in output.splitlines()[1:]:
+        [self_time, cumulative, module] = line.replace('import time:', '').split('|')
+        imports.append([int(cumulative), module.rstrip()])
+    print('\nCumulative import time in microseconds')
+    for [cumulative, module] in sorted(imports, reverse=True)[:15]:
+        print(cumulative, module, sep='\t')
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from sparql_server import Graph, Faults, make_handler, parser as server_parser
+from http.server import ThreadingHTTPServer
+from bbw.bbw import annotate, WikidataProvider
+import pandas as pd
+import argparse
+import sys
+import tempfile
+import threading
+
+# Regression check of annotate() against the local SPARQL server: a table with a column
+# without any annotation (the population literals) must still give the six frames
+parser = argparse.ArgumentParser(description='Check annotate() offline with utils/sparql_server.py.')
+parser.add_argument('--verbose', action='store_true', help='Print the annotated table.')
+
+data = """
+wd:Q2119 rdfs:label "Mannheim"@en ; wdt:P31 wd:Q515 ; wdt:P17 wd:Q183 .
+wd:Q586 rdfs:label "Bonn"@en ; wdt:P31 wd:Q515 ; wdt:P17 wd:Q183 .
+wd:Q90 rdfs:label "Paris"@en ; wdt:P31 wd:Q515 ; wdt:P17 wd:Q142 .
+wd:Q183 rdfs:label "Germany"@en ; wdt:P31 wd:Q6256 .
+wd:Q142 rdfs:label "France"@en ; wdt:P31 wd:Q6256 .
+wd:Q515 rdfs:label "city"@en .
+wd:Q6256 rdfs:label "country"@en .
+wd:P17 wikibase:directClaim wdt:P17 ; wikibase:propertyType wikibase:WikibaseItem .
+"""
+table = pd.DataFrame([['city', 'country', 'population'], ['Mannheim', 'Germany', '309721'],
+                      ['Bonn', 'Germany', '327258'], ['Paris', 'France', '2140526']])
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    graph = Graph()
+    with tempfile.NamedTemporaryFile('w', suffix='.ttl') as f:
+        f.write(data)
+        f.flush()
+        graph.load(f.name)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(graph, Faults(server_parser.parse_args(['-']))))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    front = f'http://127.0.0.1:{server.server_address[1]}'
+    provider = WikidataProvider(url=front + '/sparql', url_front=front, metalookup=False)
+    [bbwtable, urltable, labeltable, cpa_sub, cea_sub, cta_sub] = annotate(table, 'check', 'en', provider=provider)
+    if args.verbose:
+        print(bbwtable.to_string())
+    errors = []
+    if list(urltable.columns) != ['city', 'country', 'population']:
+        errors.append('unexpected columns ' + str(list(urltable.columns)))
+    if not (urltable['population'].iloc[:3] == '').all():
+        errors.append('the population column is annotated')
+    if list(bbwtable['population'].iloc[:3]) != ['309721', '327258', '2140526']:
+        errors.append('the population values are changed')
+    if urltable['city'].iloc[0] != 'http://www.wikidata.org/entity/Q2119':
+        errors.append('Mannheim is not annotated')
+    if urltable.loc['property', 'country'] != 'http://www.wikidata.org/prop/direct/P17':
+        errors.append('the property of the country column is missing')
+    server.shutdown()
+    for error in errors:
+        print('ERROR:', error)
+    print('annotate() ok' if not errors else 'annotate() failed')
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from sparql_server import Graph, Faults, make_handler, parser as server_parser
+from http.server import ThreadingHTTPServer
+from bbw.bbw import contextual_matching, preprocessing, WikidataProvider, CachedProvider
+import pandas as pd
+import argparse
+import sys
+import tempfile
+import threading
+
+# Check that the projected lookups (--projection) give the same annotations as the full lookups,
+# using the local SPARQL server. The graph has statement values (ps:), literal values, labels which
+# differ in case only and values without an exact match, which need the fallback to all claims.
+parser = argparse.ArgumentParser(description='Compare the projected lookups with the full lookups offline.')
+parser.add_argument('--verbose', action='store_true', help='Print the SPARQL requests per query kind.')
+
+data = """
+wd:Q2119 rdfs:label "Mannheim"@en ; wdt:P31 wd:Q515 ; wdt:P206 wd:Q584 ; wdt:P17 wd:Q183 ;
+    wdt:P1082 "309721" ; p:P17 wd:statement1 .
+wd:statement1 ps:P17 wd:Q183 .
+wd:Q586 rdfs:label "Bonn"@en ; wdt:P31 wd:Q515 ; wdt:P206 wd:Q584 ; wdt:P17 wd:Q183 ; wdt:P1082 "327258" .
+wd:Q90 rdfs:label "Paris"@en ; skos:altLabel "City of Light"@en ; wdt:P31 wd:Q515 ; wdt:P206 wd:Q1471 ;
+    wdt:P17 wd:Q142 ; wdt:P1082 "2140526" ; p:P17 wd:statement2 .
+wd:statement2 ps:P17 wd:Q142 .
+wd:Q1000 rdfs:label "Paris"@en ; wdt:P31 wd:Q5 ; wdt:P17 wd:Q142 .
+wd:Q584 rdfs:label "Rhine"@en ; wdt:P31 wd:Q4022 .
+wd:Q1471 rdfs:label "Seine"@en ; wdt:P31 wd:Q4022 .
+wd:Q1469 rdfs:label "Loire"@en ; wdt:P31 wd:Q4022 .
+wd:Q183 rdfs:label "Germany"@en ; wdt:P31 wd:Q6256 .
+wd:Q142 rdfs:label "France"@en ; wdt:P31 wd:Q6256 .
+wd:Q515 rdfs:label "city"@en ; wdt:P279 wd:Q486972 .
+wd:Q4022 rdfs:label "river"@en ; wdt:P279 wd:Q355304 .
+wd:Q5 rdfs:label "human"@en .
+wd:Q6256 rdfs:label "country"@en .
+wd:Q355304 wdt:P279 wd:Q2221906 .
+wd:Q486972 wdt:P279 wd:Q2221906 .
+wd:P17 wikibase:claim p:P17 ; wikibase:statementProperty ps:P17 ; wikibase:directClaim wdt:P17 ;
+    wikibase:propertyType wikibase:WikibaseItem .
+wd:P206 wikibase:directClaim wdt:P206 ; wikibase:propertyType wikibase:WikibaseItem .
+wd:P1082 wikibase:directClaim wdt:P1082 ; wikibase:propertyType wikibase:Quantity .
+"""
+table = pd.DataFrame([['city', 'river', 'country', 'population'],
+                      ['Mannheim', 'Rhine', 'Germany', '309721'],
+                      ['Bonn', 'rhine', 'GERMANY', '327258'],
+                      ['Paris', 'Seine', 'Frnce', '2140526'],
+                      ['City of Light', 'Seine', 'France', ''],
+                      ['Pariss', 'Loire', 'France', '1'],
+                      ['Mannheim', 'Rhine', 'Germany', '309721']])
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    graph = Graph()
+    with tempfile.NamedTemporaryFile('w', suffix='.ttl') as f:
+        f.write(data)
+        f.flush()
+        graph.load(f.name)
+    faults = Faults(server_parser.parse_args(['-']))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(graph, faults))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/sparql'
+    filecsv = preprocessing(table)
+    providers = {'full': WikidataProvider(url=url, metalookup=False),
+                 'projected': WikidataProvider(url=url, metalookup=False, projection=True),
+                 'projected and cached': CachedProvider(url=url, metalookup=False, projection=True)}
+    errors = []
+    for steps in [dict(step3=False, step4=False, step5=True, step6=True),
+                  dict(step3=True, step4=True, step5=True, step6=True)]:
+        outputs = {}
+        for name, provider in providers.items():
+            before = dict(faults.stats)
+            outputs[name] = contextual_matching(filecsv, 'check', 'en', provider=provider, **steps)
+            if args.verbose:
+                print(name, steps, {k: v - before.get(k, 0) for k, v in faults.stats.items() if v != before.get(k, 0)})
+        for name, output in outputs.items():
+            if output != outputs['full']:
+                errors.append(name + ' differs from the full lookups with ' + str(steps))
+    server.shutdown()
+    for error in errors:
+        print('ERROR:', error)
+    print('projection ok' if not errors else 'projection failed')
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import csv
+import argparse
+
+# Columns of the targets and the submissions in SemTab-format and the key used to join them
+tasks = {'cpa': {'target': ['tableID', 'col0', 'colx'], 'submission': ['tableID', 'col0', 'colx', 'property'],
+                 'key': ['tableID', 'colx']},
+         'cea': {'target': ['tableID', 'row', 'col'], 'submission': ['tableID', 'row', 'col', 'item'],
+                 'key': ['tableID', 'row', 'col']},
+         'cta': {'target': ['tableID', 'col'], 'submission': ['tableID', 'col', 'type'],
+                 'key': ['tableID', 'col']}}
+
+parser = argparse.ArgumentParser(description='Merge several CPA, CEA or CTA submissions. '
+                                             'For each target the value of the first submission which has one wins.')
+parser.add_argument('task', choices=sorted(tasks), help='The task of the submissions.')
+parser.add_argument('target', help='The target CSV-file.')
+parser.add_argument('submissions', nargs='+', help='The submission CSV-files. The order is important as the first value will beat the later ones!')
+parser.add_argument('--output', nargs='?', default='merged.csv', help='The merged submission. The default is merged.csv.')
+parser.add_argument('--conflicts', nargs='?', help='CSV-file for the conflicts: keys with several values in one submission and keys with different values in several submissions.')
+
+
+def merge(target, submissions, task):
+    """Merge the submissions (dataframes in the order of priority) for the target dataframe.
+    The keys of the target are hashed once and each submission is joined to them by a
+    single lookup, so the priorities are applied on integer positions.
+    Returns [merged, conflicts]: the merged submission in the order of the target and
+    a dataframe with the duplicates and the differing values, which lose."""
+    key = tasks[task]['key']
+    value = tasks[task]['submission'][-1]
+    index = pd.MultiIndex.from_frame(target[key].drop_duplicates())
+    candidates = []
+    conflicts = []
+    for priority, submission in enumerate(submissions):
+        position = index.get_indexer(pd.MultiIndex.from_frame(submission[key]))
+        submission = submission[key + [value]].assign(position=position, priority=priority)
+        submission = submission[submission.position >= 0]
+        # A key with several values in one submission is not used from this submission
+        duplicated = submission.position.duplicated(keep=False)
+        if duplicated.any():
+            conflicts.append(submission[duplicated].assign(conflict='duplicate'))
+        candidates.append(submission[~duplicated])
+    candidates = pd.concat(candidates, ignore_index=True)
+    candidates = candidates[candidates[value].notna() & (candidates[value] != '')]
+    winners = candidates.sort_values('priority', kind='stable').drop_duplicates('position')
+    winner = pd.Series(winners[value].values, index=winners.position.values)
+    winner_priority = pd.Series(winners.priority.values, index=winners.position.values)
+    others = candidates[(candidates.priority.values != winner_priority.reindex(candidates.position).values) &
+                        (candidates[value].values != winner.reindex(candidates.position).values)]
+    conflicts.append(others.assign(conflict='diff'))
+    conflicts = pd.concat(conflicts, ignore_index=True).drop(columns=['position'])
+    merged = target.assign(**{value: winner.reindex(index.get_indexer(pd.MultiIndex.from_frame(target[key]))).values})
+    merged = merged[merged[value].notna()]
+    return [merged[tasks[task]['target'] + [value]].reset_index(drop=True), conflicts]
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    target = pd.read_csv(args.target, dtype=object, names=tasks[args.task]['target'])
+    submissions = [pd.read_csv(file, dtype=object, names=tasks[args.task]['submission']) for file in args.submissions]
+    [merged, conflicts] = merge(target, submissions, args.task)
+    print(len(merged), 'of', len(target), 'targets are merged.')
+    print(sum(conflicts.conflict == 'duplicate'), 'values are ignored, because there are several values for the same key in one submission.')
+    print(sum(conflicts.conflict == 'diff'), 'values differ from the value of a preceding submission and lose.')
+    if args.conflicts:
+        conflicts['submission'] = conflicts.priority.map(lambda priority: args.submissions[priority])
+        conflicts.drop(columns=['priority']).to_csv(args.conflicts, index=False, quoting=csv.QUOTE_ALL)
+    merged.to_csv(args.output, index=False, header=False, quoting=csv.QUOTE_ALL)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from bbw.scoring import read_annotations, score
+import pandas as pd
+import argparse
+
+parser = argparse.ArgumentParser(description='Score CEA, CPA and CTA submissions against the ground truth of SemTab.')
+for task in ['cea', 'cpa', 'cta']:
+    parser.add_argument(f'--{task}', nargs=2, metavar=('SUBMISSION', 'GROUNDTRUTH'),
+                        help=f'The {task.upper()} submission and ground-truth CSV-files.')
+parser.add_argument('--output', nargs='?', help='CSV-file for the scores.')
+args = parser.parse_args()
+
+scores = []
+for task in ['cea', 'cpa', 'cta']:
+    if getattr(args, task):
+        [submission, truth] = [read_annotations(path, task) for path in getattr(args, task)]
+        scores.append(score(submission, truth, task)[0])
+scores = pd.DataFrame(scores)
+print(scores.to_string(index=False))
+if args.output:
+    scores.to_csv(args.output, index=False)
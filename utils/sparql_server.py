@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from collections import defaultdict, deque, namedtuple
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+# Local stand-in for the Wikidata SPARQL-endpoint. It answers the query shapes of bbw from
+# an N-Triples or simple Turtle file, so throughput, rate limiting and retries can be tested offline:
+#   python3 sparql_server.py data.nt --port 8503 --latency 0.2 --p429 0.05
+#   python3 bbw_cli.py --endpoint http://127.0.0.1:8503/sparql
+parser = argparse.ArgumentParser()
+parser.add_argument('data', nargs='+', help='N-Triples or Turtle files (prefixes, ";" and "," are supported, nested blank nodes are not).')
+parser.add_argument('--host', nargs='?', default='127.0.0.1', help='The host of the server. The default is 127.0.0.1.')
+parser.add_argument('--port', nargs='?', type=int, default=8503, help='The port of the server. The default is 8503.')
+parser.add_argument('--latency', nargs='?', type=float, default=0.0, help='Seconds added to each answer.')
+parser.add_argument('--jitter', nargs='?', type=float, default=0.0, help='Up to this many seconds are added randomly to each answer.')
+parser.add_argument('--kind-latency', nargs='*', default=[], help='Latency per query kind, e.g. label=0.3 type2=2. It replaces --latency for this kind.')
+parser.add_argument('--rate-limit', nargs='?', type=float, help='Requests per second. Further requests get HTTP 429 with Retry-After.')
+parser.add_argument('--p429', nargs='?', type=float, default=0.0, help='Probability of HTTP 429 with Retry-After for any request.')
+parser.add_argument('--retry-after', nargs='?', type=int, default=1, help='The Retry-After header of HTTP 429 in seconds. The default is 1.')
+parser.add_argument('--p-timeout', nargs='?', type=float, default=0.0, help='Probability that a request hangs for --hang seconds before it is answered.')
+parser.add_argument('--hang', nargs='?', type=float, default=60.0, help='Seconds a hanging request waits. The default is 60.')
+parser.add_argument('--seed', nargs='?', type=int, help='Seed for the injected faults.')
+
+prefixes = {'wd': 'http://www.wikidata.org/entity/',
+            'wdt': 'http://www.wikidata.org/prop/direct/',
+            'p': 'http://www.wikidata.org/prop/',
+            'ps': 'http://www.wikidata.org/prop/statement/',
+            'wikibase': 'http://wikiba.se/ontology#',
+            'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+            'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+            'skos': 'http://www.w3.org/2004/02/skos/core#',
+            'schema': 'http://schema.org/',
+            'xsd': 'http://www.w3.org/2001/XMLSchema#'}
+LABEL = prefixes['rdfs'] + 'label'
+ALTLABEL = prefixes['skos'] + 'altLabel'
+SUBCLASS = prefixes['wdt'] + 'P279'
+
+Literal = namedtuple('Literal', ['value', 'lang', 'datatype'])
+
+TOKEN = re.compile(r'''\s*(?:
+    (?P<iri><[^>]*>)
+  | (?P<literal>"(?:[^"\\]|\\.)*"(?:@[A-Za-z][\w-]*|\^\^(?:<[^>]*>|[A-Za-z_][\w-]*:[\w-]*))?)
+  | (?P<bnode>_:[\w-]+)
+  | (?P<directive>@prefix|PREFIX)\b
+  | (?P<a>a)(?=\s)
+  | (?P<pname>[A-Za-z_]?[\w-]*:(?:[\w-]+(?:\.[\w-]+)*)?)
+  | (?P<punct>[.;,])
+  | (?P<comment>\#[^\n]*)
+)''', re.VERBOSE)
+ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def unescape(text):
+    return ESCAPE.sub(lambda m: chr(int(m.group(1)[1:], 16)) if m.group(1)[0] in 'uU' and len(m.group(1)) > 1
+                      else ESCAPES.get(m.group(1), m.group(1)), text)
+
+
+def parse_literal(token, namespaces):
+    end = token.rindex('"')
+    value = unescape(token[1:end])
+    suffix = token[end + 1:]
+    if suffix.startswith('@'):
+        return Literal(value, suffix[1:], None)
+    if suffix.startswith('^^'):
+        return Literal(value, None, parse_term('pname' if not suffix[2:].startswith('<') else 'iri', suffix[2:],
+                                               namespaces))
+    return Literal(value, None, None)
+
+
+def parse_term(kind, token, namespaces):
+    if kind == 'iri':
+        return token[1:-1]
+    if kind == 'pname':
+        prefix, local = token.split(':', 1)
+        return namespaces[prefix] + local
+    if kind == 'literal':
+        return parse_literal(token, namespaces)
+    if kind == 'bnode':
+        return token
+    if kind == 'a':
+        return prefixes['rdf'] + 'type'
+    raise ValueError('Unexpected token ' + token)
+
+
+def parse_triples(text):
+    """Parse N-Triples or a simple Turtle document and yield the triples (s, p, o).
+    IRIs and blank nodes are strings, literals are Literal(value, lang, datatype)."""
+    namespaces = dict(prefixes)
+    tokens = [(m.lastgroup, m.group(m.lastgroup)) for m in TOKEN.finditer(text) if m.lastgroup != 'comment']
+    i = 0
+    subject = predicate = None
+    while i < len(tokens):
+        kind, token = tokens[i]
+        if kind == 'directive':
+            namespaces[tokens[i + 1][1].rstrip(':')] = tokens[i + 2][1][1:-1]
+            i += 3
+            if i < len(tokens) and tokens[i][1] == '.':
+                i += 1
+            continue
+        if subject is None:
+            subject = parse_term(kind, token, namespaces)
+        elif predicate is None:
+            predicate = parse_term(kind, token, namespaces)
+        elif kind == 'punct':
+            if token == '.':
+                subject = predicate = None
+            elif token == ';':
+                predicate = None
+        else:
+            yield (subject, predicate, parse_term(kind, token, namespaces))
+        i += 1
+
+
+class Graph:
+    """Triples indexed by subject (spo) and by object (osp) with the label service of Wikidata."""
+
+    def __init__(self):
+        self.spo = defaultdict(lambda: defaultdict(list))
+        self.osp = defaultdict(list)
+        self.statement_properties = {}  # p:P.. -> ps:P..
+        self.size = 0
+
+    def add(self, s, p, o):
+        self.spo[s][p].append(o)
+        self.osp[o].append((s, p))
+        self.size += 1
+
+    def load(self, path):
+        with open(path, encoding='utf-8') as f:
+            for triple in parse_triples(f.read()):
+                self.add(*triple)
+        claims = {s: self.spo[s][prefixes['wikibase'] + 'claim'] for s in list(self.spo)
+                  if prefixes['wikibase'] + 'claim' in self.spo[s]}
+        for wdproperty, claim in claims.items():
+            for psproperty in self.spo[wdproperty].get(prefixes['wikibase'] + 'statementProperty', []):
+                for c in claim:
+                    self.statement_properties[c] = psproperty
+
+    def objects(self, s, p):
+        return self.spo[s].get(p, []) if s in self.spo else []
+
+    def subjects(self, o, p=None):
+        return [s for (s, q) in self.osp.get(o, []) if p is None or q == p]
+
+    def labels(self, s, lang, properties=(LABEL,)):
+        return [o.value for p in properties for o in self.objects(s, p) if isinstance(o, Literal) and o.lang == lang]
+
+    def label(self, term, lang):
+        """SERVICE wikibase:label: the label in lang, otherwise the QID, for literals their value."""
+        if isinstance(term, Literal):
+            return term.value
+        labels = self.labels(term, lang)
+        return labels[0] if labels else term.rsplit('/', 1)[-1]
+
+
+def binding(term):
+    if isinstance(term, Literal):
+        value = {'type': 'literal', 'value': term.value}
+        if term.lang:
+            value['xml:lang'] = term.lang
+        elif term.datatype:
+            value['datatype'] = term.datatype
+        return value
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    return {'type': 'uri', 'value': term}
+
+
+def results(variables, rows, limit=None):
+    """SPARQL JSON results of the rows (dicts of terms), without duplicates."""
+    bindings, seen = [], set()
+    for row in rows:
+        row = {k: v for k, v in row.items() if v is not None}
+        key = tuple(sorted(row.items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        bindings.append({k: binding(v) for k, v in row.items()})
+        if limit and len(bindings) >= limit:
+            break
+    return {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+
+
+STRING = r'"((?:[^"\\]|\\.)*)"'
+
+
+def answer(graph, query):
+    """Answer a query of bbw. Returns [kind, results]. The kind is the same as in get_SPARQL_results()."""
+    limit = re.search(r'LIMIT\s+(\d+)', query)
+    limit = int(limit.group(1)) if limit else None
+    ptype = re.search(r'wdt:(P\d+) (?:\?itemType|\?valueType|wd:)', query)
+    ptype = prefixes['wdt'] + (ptype.group(1) if ptype else 'P31')
+
+    def with_ps(p2, value, lang):
+        """The optional ?psvalueLabel of a statement node."""
+        psproperty = graph.statement_properties.get(p2)
+        psvalues = graph.objects(value, psproperty) if psproperty else []
+        return [graph.label(psvalue, lang) for psvalue in psvalues] or [None]
+
+    def row_values(item, lang):
+        for p2, values in list(graph.spo[item].items()):
+            for value in values:
+                value_types = (graph.objects(value, ptype) if not isinstance(value, Literal) else []) or [None]
+                for value_type in value_types:
+                    for psvalue_label in with_ps(p2, value, lang):
+                        yield p2, value, value_type, psvalue_label
+
+    if 'gas:service' in query:
+        classes = [prefixes['wd'] + q for q in re.findall(r'gas:in wd:(\w+)', query)]
+        distances = []
+        for c in classes:
+            distance, frontier = {c: 0}, [c]
+            for iteration in range(10):
+                frontier = [o for s in frontier for o in graph.objects(s, SUBCLASS) if o not in distance]
+                for o in frontier:
+                    distance.setdefault(o, iteration + 1)
+            distances.append(distance)
+        common = set.intersection(*[set(d) for d in distances]) if distances else set()
+        ranked = sorted((sum(d[s] for d in distances), s) for s in common)
+        rows = [{'super': s, 'length': Literal(str(length), None, prefixes['xsd'] + 'integer')} for length, s in ranked]
+        return ['common_class', results(['super', 'length'], rows, limit)]
+    if 'wikibase:directClaim' in query:
+        pid = re.search(r'wikibase:directClaim wdt:(\w+)', query).group(1)
+        rows = [{'datatype': datatype} for x in graph.subjects(prefixes['wdt'] + pid, prefixes['wikibase'] + 'directClaim')
+                for datatype in graph.objects(x, prefixes['wikibase'] + 'propertyType')]
+        return ['datatype', results(['datatype'], rows, limit)]
+    if 'VALUES ?p2' in query:
+        names = re.findall(STRING + r'@([\w-]+)', re.search(r'VALUES \?name \{(.*?)\}', query, re.S).group(1))
+        props = re.findall(r'<([^>]*)>', re.search(r'VALUES \?p2 \{(.*?)\}', query, re.S).group(1))
+        datatype = prefixes['wd'] + re.search(r' wd:(\w+);', query).group(1)
+        lang = re.search(r'wikibase:language "([\w-]+)"', query).group(1)
+        rows = []
+        for name, name_lang in names:
+            literal = Literal(unescape(name), name_lang, None)
+            for item in graph.subjects(literal, LABEL) + graph.subjects(literal, ALTLABEL):
+                if datatype not in graph.objects(item, ptype):
+                    continue
+                for item_type in graph.objects(item, ptype):
+                    for p2 in props:
+                        for value in graph.objects(item, p2):
+                            value_types = (graph.objects(value, ptype) if not isinstance(value, Literal) else []) or [None]
+                            for value_type in value_types:
+                                rows.append({'name': literal, 'item': item, 'itemType': item_type, 'p2': p2,
+                                             'value': value, 'valueType': value_type,
+                                             'valueLabel': Literal(graph.label(value, lang), lang, None)})
+        return ['constrained', results(['name', 'item', 'itemType', 'p2', 'value', 'valueType', 'valueLabel'],
+                                       rows, limit)]
+    if 'VALUES ?name' in query:
+        names = re.findall(STRING + r'@([\w-]+)', re.search(r'VALUES \?name \{(.*?)\}', query, re.S).group(1))
+        datatype = prefixes['wd'] + re.search(r' wd:(\w+)\.', query).group(1)
+        lang = re.search(r'wikibase:language "([\w-]+)"', query).group(1)
+        rows = []
+        for name, name_lang in names:
+            literal = Literal(unescape(name), name_lang, None)
+            for item in graph.subjects(literal, LABEL) + graph.subjects(literal, ALTLABEL):
+                if datatype in graph.objects(item, ptype):
+                    rows.append({'name': literal, 'item': item, 'itemLabel': Literal(graph.label(item, lang), lang, None)})
+        return ['type_batch', results(['name', 'item', 'itemLabel'], rows, limit)]
+    if 'VALUES ?item' in query:
+        items = re.findall(r'<([^>]*)>', re.search(r'VALUES \?item \{(.*?)\}', query, re.S).group(1))
+        lang = re.search(r'wikibase:language "([\w-]+)"', query).group(1)
+        rows = []
+        for item in items:
+            for item_type in graph.objects(item, ptype) or [None]:
+                for p2, value, value_type, psvalue_label in row_values(item, lang):
+                    rows.append({'item': item, 'itemType': item_type, 'p2': p2, 'value': value,
+                                 'valueType': value_type, 'valueLabel': Literal(graph.label(value, lang), lang, None),
+                                 'psvalueLabel': Literal(psvalue_label, lang, None) if psvalue_label else None})
+        if 'LCASE(' in query:
+            # get_SPARQL_claims_projected(): only the claims whose label is one of the keys
+            keys = re.search(r'\) IN \((.*?)\)\)', query, re.S).group(1)
+            keys = set(unescape(key) for key in re.findall(STRING, keys))
+            rows = [row for row in rows if (row['psvalueLabel'] or row['valueLabel']).value.lower() in keys]
+            return ['projected', results(['item', 'itemType', 'p2', 'value', 'valueType', 'valueLabel', 'psvalueLabel'],
+                                         rows, limit)]
+        return ['claims', results(['item', 'itemType', 'p2', 'value', 'valueType', 'valueLabel', 'psvalueLabel'],
+                                  rows, limit)]
+    if '[]  wdt:' in query or '[] wdt:' in query:
+        datatype = prefixes['wd'] + re.search(r' wd:(\w+);', query).group(1)
+        lang = re.search(r'lang\(\?itemLabel\) = "([\w-]+)"', query).group(1)
+        rows = [{'itemLabel': Literal(label, lang, None)} for item in graph.subjects(datatype, ptype)
+                for label in graph.labels(item, lang, (LABEL, ALTLABEL))]
+        return ['type2', results(['itemLabel'], rows, limit)]
+    if '(rdfs:label|skos:altLabel) "' in query:
+        name, name_lang = re.search(r'\(rdfs:label\|skos:altLabel\) ' + STRING + r'@([\w-]+)', query).groups()
+        datatype = prefixes['wd'] + re.search(r' wd:(\w+)\.', query).group(1)
+        lang = re.search(r'wikibase:language "([\w-]+)"', query).group(1)
+        literal = Literal(unescape(name), name_lang, None)
+        rows = [{'item': item, 'itemLabel': Literal(graph.label(item, lang), lang, None)}
+                for item in graph.subjects(literal, LABEL) + graph.subjects(literal, ALTLABEL)
+                if datatype in graph.objects(item, ptype)]
+        return ['type', results(['item', 'itemLabel'], rows, limit)]
+    def prop_rows(pairs, key=None):
+        items = None
+        for prop, literal in pairs:
+            found = {item for node in graph.subjects(literal) for item in graph.subjects(node, prop)}
+            items = found if items is None else items & found
+        rows = []
+        for item in sorted(items or []):
+            for item_type in graph.objects(item, ptype):
+                for item_label in graph.labels(item, 'en'):
+                    for p2, value, value_type, psvalue_label in row_values(item, 'en'):
+                        rows.append({'key': key, 'item': item, 'itemType': item_type,
+                                     'itemLabel': Literal(item_label, 'en', None),
+                                     'p2': p2, 'value': value, 'valueType': value_type,
+                                     'valueLabel': Literal(graph.label(value, 'en'), 'en', None),
+                                     'psvalueLabel': Literal(psvalue_label, 'en', None) if psvalue_label else None})
+        return rows
+
+    if 'VALUES (?key' in query:
+        props = [prefixes['wdt'] + p for p in re.findall(r'wdt:(\S+) \[ \?p \?label\d+ \]', query)]
+        rows = []
+        for key, values in re.findall(r'\((\d+)((?:\s+"(?:[^"\\]|\\.)*"@en)+)\)', query):
+            literals = [Literal(unescape(v), 'en', None) for v in re.findall(STRING, values)]
+            rows.extend(prop_rows(zip(props, literals), Literal(key, None, prefixes['xsd'] + 'integer')))
+        return ['prop_batch', results(['key', 'item', 'itemType', 'itemLabel', 'p2', 'value', 'valueType', 'valueLabel',
+                                       'psvalueLabel'], rows, limit)]
+    if '[ ?p "' in query:
+        pairs = [(prefixes['wdt'] + p, Literal(unescape(v), 'en', None))
+                 for p, v in re.findall(r'wdt:(\S+) \[ \?p ' + STRING + r'@en \]', query)]
+        return ['prop', results(['item', 'itemType', 'itemLabel', 'p2', 'value', 'valueType', 'valueLabel',
+                                 'psvalueLabel'], prop_rows(pairs), limit)]
+    if '?value rdfs:label "' in query:
+        name, lang = re.search(r'\?value rdfs:label ' + STRING + r'@([\w-]+)', query).groups()
+        literal = Literal(unescape(name), lang, None)
+        values = [(value, value_type) for value in graph.subjects(literal, LABEL)
+                  for value_type in graph.objects(value, ptype)]
+        rows = []
+        for node in set(graph.subjects(literal)):
+            for (item, p2) in graph.osp.get(node, []):
+                for item_type in graph.objects(item, ptype):
+                    for item_label in graph.labels(item, 'en'):
+                        for value, value_type in values:
+                            rows.append({'value': value, 'valueType': value_type, 'p2': p2, 'item': item,
+                                         'itemType': item_type, 'itemLabel': Literal(item_label, 'en', None)})
+        return ['item', results(['value', 'valueType', 'p2', 'item', 'itemType', 'itemLabel'], rows, limit)]
+    if '?item ?p1 "' in query and '?p2' not in query:
+        name, lang = re.search(r'\?item \?p1 ' + STRING + r'@([\w-]+)', query).groups()
+        rows = [{'item': item, 'p1': p1} for (item, p1) in graph.osp.get(Literal(unescape(name), lang, None), [])]
+        return ['items', results(['item', 'p1'], rows, limit)]
+    if '?item ?p1 "' in query:
+        name, lang = re.search(r'\?item \?p1 ' + STRING + r'@([\w-]+)', query).groups()
+        literal = Literal(unescape(name), lang, None)
+        item_label = 'rdfs:label ?itemLabel' in query
+        rows = []
+        for (item, p1) in graph.osp.get(literal, []):
+            item_labels = graph.labels(item, lang) if item_label else [None]
+            for label in item_labels:
+                for item_type in graph.objects(item, ptype) or [None]:
+                    for p2, value, value_type, psvalue_label in row_values(item, lang):
+                        rows.append({'item': item, 'itemLabel': Literal(label, lang, None) if label else None,
+                                     'itemType': item_type, 'p1': p1, 'p2': p2, 'value': value,
+                                     'valueType': value_type,
+                                     'valueLabel': Literal(graph.label(value, lang), lang, None),
+                                     'psvalueLabel': Literal(psvalue_label, lang, None) if psvalue_label else None})
+        return ['label', results(['item', 'itemLabel', 'itemType', 'p1', 'p2', 'value', 'valueType', 'valueLabel',
+                                  'psvalueLabel'], rows, limit)]
+    raise ValueError('Unknown query shape')
+
+
+class Faults:
+    """Injected latency, HTTP 429 and hanging requests, and the statistics of the server."""
+
+    def __init__(self, args):
+        self.args = args
+        self.kind_latency = {k: float(v) for k, v in (kv.split('=') for kv in args.kind_latency)}
+        self.random = random.Random(args.seed)
+        self.recent = deque()
+        self.stats = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def too_many(self):
+        now = time.time()
+        with self.lock:
+            while self.recent and now - self.recent[0] > 1:
+                self.recent.popleft()
+            limited = self.args.rate_limit is not None and len(self.recent) >= self.args.rate_limit
+            if not limited:
+                self.recent.append(now)
+            return limited or self.random.random() < self.args.p429
+
+    def hangs(self):
+        with self.lock:
+            return self.random.random() < self.args.p_timeout
+
+    def delay(self, kind):
+        with self.lock:
+            jitter = self.random.uniform(0, self.args.jitter) if self.args.jitter else 0
+        return self.kind_latency.get(kind, self.args.latency) + jitter
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+def make_handler(graph, faults):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send(self, status, data, headers=None):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/sparql-results+json' if status == 200 else 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                faults.count('disconnected')
+
+        def handle_query(self, query):
+            if not query:
+                with faults.lock:
+                    stats = dict(faults.stats)
+                self.send(200, {'triples': graph.size, 'requests': stats})
+                return
+            faults.count('requests')
+            if faults.too_many():
+                faults.count('429')
+                self.send(429, {'error': 'Too many requests'}, {'Retry-After': str(faults.args.retry_after)})
+                return
+            try:
+                [kind, data] = answer(graph, query)
+            except Exception as e:
+                faults.count('400')
+                self.send(400, {'error': 'Unsupported query: ' + str(e)})
+                return
+            faults.count(kind)
+            if faults.hangs():
+                faults.count('hang')
+                time.sleep(faults.args.hang)
+            time.sleep(faults.delay(kind))
+            self.send(200, data)
+
+        def do_GET(self):
+            self.handle_query(parse_qs(urlparse(self.path).query).get('query', [''])[0])
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            if 'sparql-query' in self.headers.get('Content-Type', ''):
+                self.handle_query(body)
+            else:
+                self.handle_query(parse_qs(body).get('query', [''])[0])
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    graph = Graph()
+    for path in args.data:
+        graph.load(path)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(graph, Faults(args)))
+    print(f'{graph.size} triples at http://{args.host}:{args.port}/sparql (GET without query for statistics)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()